@@ -1,190 +1,2340 @@
 #!/usr/bin/env python
 
-import getopt,sys,signal
+import getopt,sys,signal,os
+import glob
+import time
+import hashlib
+import json
+import cPickle as pickle
+from collections import OrderedDict, deque
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
 from numpy import NaN, Inf, arange, isscalar, asarray
-import csv
+import numpy as np
 
-import matplotlib.pyplot as plt
+def pyplot():
+    """
+    matplotlib.pyplot, imported on first use so that only plotting pays
+    for it
+    """
+    import matplotlib.pyplot
+    return matplotlib.pyplot
 
-def valToIdx( val, data ):
+def valToIdx( val, data, compat=True ):
     '''
         find the index of first element in data
         which is >= val
 
         assuming data is ordered list of values...
+
+        val can be an array, giving an array of indices. compat keeps
+        what the original linear scan returned: one past that element,
+        and 0 for any val <= 0.
     '''
-    idx = 0
-    cur = 0
-    val = float(val)
-    while cur < val and idx < len(data):
-        cur = data[idx]
-        idx += 1
+    vals = asarray(val, dtype=np.float64)
+    idx = np.searchsorted(asarray(data), vals, side='left')
+    if compat:
+        idx = np.where(vals <= 0, 0, np.minimum(idx + 1, len(data)))
+
+    if idx.ndim == 0:
+        return int(idx)
+    return idx
+
+def getLowestInNeighbourhood( data, index, numnei ):
+    """
+    finds the lowest value in vector data in the range
+    (data[index - numnei], data[index + numnei])
+    """
+
+    minIdx = max(index - numnei, 0)
+    maxIdx = min(index + numnei, len(data))
+
+    lowest = +Inf
+    lowest_idx = minIdx
+
+    for i in range(minIdx,maxIdx):
+        if data[i] < lowest:
+            lowest = data[i]
+            lowest_idx = i
+
+    #print minIdx, maxIdx, lowest, lowest_idx
+    return lowest,lowest_idx
+
+class SlidingMinimum:
+    """
+    lowest value in every window of a fixed width, precomputed in one pass
+    with the van Herk/Gil-Werman trick: split data into blocks of the window
+    width, take running minima forwards and backwards within each block, and
+    any window is then covered by one suffix and one prefix.
+
+    Ties go to the first occurrence and NaNs are skipped, as in
+    getLowestInNeighbourhood.
+    """
+    def __init__( self, data, width ):
+        # NaN never compares lower, so it behaves exactly like +Inf here
+        work = np.array(data, dtype=np.float64)
+        work[np.isnan(work)] = Inf
+
+        n = len(work)
+        w = max(1, min(width, n))
+        nblocks = n // w + 2
+        padded = np.empty(nblocks*w)
+        padded[:n] = work
+        padded[n:] = Inf
+        blocks = padded.reshape(nblocks, w)
+        cols = arange(w)
+        starts = (arange(nblocks)*w)[:,None]
+
+        # running minimum from the start of each block
+        pre = np.minimum.accumulate(blocks, axis=1)
+        newmin = np.ones(blocks.shape, dtype=bool)
+        newmin[:,1:] = blocks[:,1:] < pre[:,:-1]
+        preidx = np.maximum.accumulate(np.where(newmin, cols, 0), axis=1)
+
+        # running minimum from the end of each block
+        suf = np.minimum.accumulate(blocks[:,::-1], axis=1)[:,::-1]
+        sufidx = np.where(blocks == suf, cols, w)
+        sufidx = np.minimum.accumulate(sufidx[:,::-1], axis=1)[:,::-1]
+
+        self.width = w
+        self.values = work
+        self.pre = pre.ravel()
+        self.preidx = (preidx + starts).ravel()
+        self.suf = suf.ravel()
+        self.sufidx = (sufidx + starts).ravel()
+
+    def argmin( self, lo ):
+        """
+        index of the lowest value in data[lo:lo+width] for an array of lo,
+        windows running off the end are clipped
+        """
+        hi = lo + self.width - 1
+        left = self.suf[lo] <= self.pre[hi]
+        return np.where(left, self.sufidx[lo], self.preidx[hi])
+
+    def argminFromStart( self, hi ):
+        """
+        index of the lowest value in data[0:hi], for hi <= width
+        """
+        return self.preidx[hi - 1]
+
+    def argminAround( self, positions, numnei ):
+        """
+        index of the lowest value within +- numnei of each position, as
+        getLowestInNeighbourhood (width must be 2*numnei)
+        """
+        positions = asarray(positions, dtype=np.int64)
+        lo = positions - numnei
+
+        # windows clipped at the start of data are prefixes of the first block
+        clipped = lo < 0
+        idx = np.empty(len(positions), dtype=np.int64)
+        idx[~clipped] = self.argmin( lo[~clipped] )
+        idx[clipped] = self.argminFromStart( np.minimum(positions[clipped] + numnei, len(self.values)) )
+        return idx
+
+# 'auto' base search switches to SlidingMinimum once the per peak scans
+# would cover more than this fraction of the series
+WINDOW_BASES_FRACTION = 0.125
+
+def findBases( v, positions, numnei, mode='auto' ):
+    """
+    finds the base of every peak in positions - the same as calling
+    getLowestInNeighbourhood for each one.
+
+    mode 'scan' does exactly that, 'window' answers every peak from a
+    SlidingMinimum built once over v, and 'auto' picks 'window' when the
+    scans would cover a good part of v anyway.
+
+    returns arrays of the base positions and values
+    """
+    if mode == 'auto':
+        covered = 2 * numnei * len(positions)
+        mode = 'window' if covered > WINDOW_BASES_FRACTION * len(v) else 'scan'
+
+    if mode == 'scan':
+        bases = []
+        for pos in positions:
+            base,basepos = getLowestInNeighbourhood( v, pos, numnei )
+            bases.append((basepos,base))
+        return tabArrays( bases )
+
+    if mode != 'window':
+        raise ValueError('unknown base mode %s' % mode)
+
+    if len(positions) == 0:
+        return tabArrays( [] )
+
+    window = SlidingMinimum( v, 2*numnei )
+    idx = window.argminAround( positions, numnei )
+    return idx, window.values[idx]
+
+def tabArrays( tab ):
+    """
+    splits a list of (position, value) tuples into arrays of positions and
+    values
+    """
+    if len(tab) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0)
+    positions, values = zip(*tab)
+    return asarray(positions, dtype=np.int64), asarray(values, dtype=np.float64)
+
+# one row per peak, with its base and the time since the previous peak. An
+# index is a position in the series (or segment), time is in samples until
+# the timestamps are filled in by PeakResult.Segment.
+PEAK_FIELDS = [ ('index', np.int64), ('time', np.float64), ('value', np.float64),
+                ('base_index', np.int64), ('base_value', np.float64),
+                ('delta', np.float64), ('isp', np.float64) ]
+MINIMUM_FIELDS = [ ('index', np.int64), ('time', np.float64), ('value', np.float64) ]
+
+# one row of PeakFinder.Summary per series and segment, rate in peaks per
+# unit time
+SUMMARY_FIELDS = [ ('series', np.int32), ('segment', np.int32), ('start', np.float64), ('end', np.float64),
+                   ('count', np.int64), ('rate', np.float64),
+                   ('mean_delta', np.float64), ('median_delta', np.float64), ('std_delta', np.float64),
+                   ('mean_isp', np.float64), ('median_isp', np.float64), ('std_isp', np.float64) ]
+
+class PeakResult:
+    """
+    what PeakDetector finds: peaks, a structured array of PEAK_FIELDS, and
+    minima, one of MINIMUM_FIELDS. has_bases is False when no bases were
+    asked for (numnei <= 0), leaving base_value and delta NaN.
+
+    result['Maxima'], result['Minima'] and result['Bases'] give the same
+    lists of (position, value) tuples as the original PeakDetector, built
+    only when first asked for.
+    """
+    def __init__( self, peaks, minima, has_bases=True ):
+        self.peaks = peaks
+        self.minima = minima
+        self.has_bases = has_bases
+        self.lists = {}
+
+    def __getitem__( self, key ):
+        if key not in self.lists:
+            if key == 'Maxima':
+                tab = zip( self.peaks['index'].tolist(), self.peaks['value'] )
+            elif key == 'Minima':
+                tab = zip( self.minima['index'].tolist(), self.minima['value'] )
+            elif key == 'Bases':
+                tab = []
+                if self.has_bases:
+                    tab = zip( self.peaks['base_index'].tolist(), self.peaks['base_value'] )
+            else:
+                raise KeyError(key)
+            self.lists[key] = tab
+        return self.lists[key]
+
+    def __len__( self ):
+        return len(self.peaks)
+
+    def __getstate__( self ):
+        # the lists are only a view, don't cache or send them
+        return (self.peaks, self.minima, self.has_bases)
+
+    def __setstate__( self, state ):
+        self.peaks, self.minima, self.has_bases = state
+        self.lists = {}
+
+    def Segment( self, start, stop, times ):
+        """
+        the peaks and minima in [start, stop), with positions relative to
+        start, times taken from the timestamps and ISPs between the peaks
+        of the segment only
+        """
+        lo, hi = np.searchsorted( self.peaks['index'], [start, stop] )
+        mlo, mhi = np.searchsorted( self.minima['index'], [start, stop] )
+        peaks = self.peaks[lo:max(lo, hi)].copy()
+        minima = self.minima[mlo:max(mlo, mhi)].copy()
+
+        peaks['time'] = times[ peaks['index'] ]
+        minima['time'] = times[ minima['index'] ]
+        peaks['isp'][:1] = NaN
+        peaks['isp'][1:] = np.diff( peaks['time'] )
+
+        peaks['index'] -= start
+        minima['index'] -= start
+        if self.has_bases:
+            peaks['base_index'] -= start
+        return PeakResult( peaks, minima, self.has_bases )
+
+    def Stats( self ):
+        """
+        number of peaks, then the mean, median and std of their Deltas and
+        of their ISPs. Without bases there are no Deltas, their stats are
+        NaN.
+        """
+        deltas = describe( self.peaks['delta'] if self.has_bases else [] )
+        return (len(self.peaks),) + deltas + describe( self.peaks['isp'][1:] )
+
+def describe( x ):
+    """
+    mean, median and std of x, NaN if x is empty
+    """
+    if len(x) == 0:
+        return (NaN, NaN, NaN)
+    return (np.mean(x), np.median(x), np.std(x))
+
+def peakResult( maxima, minima, bases=None ):
+    """
+    builds a PeakResult from (positions, values) arrays of the maxima,
+    minima and bases (None for no bases), with times in samples
+    """
+    maxpos, maxval = maxima
+    minpos, minval = minima
+
+    peaks = np.zeros( len(maxpos), dtype=PEAK_FIELDS )
+    peaks['index'] = maxpos
+    peaks['time'] = maxpos
+    peaks['value'] = maxval
+    peaks['isp'][:1] = NaN
+    peaks['isp'][1:] = np.diff( peaks['time'] )
+    if bases is None:
+        peaks['base_index'] = -1
+        peaks['base_value'] = NaN
+        peaks['delta'] = NaN
+    else:
+        peaks['base_index'], peaks['base_value'] = bases
+        peaks['delta'] = peaks['value'] - peaks['base_value']
+
+    mins = np.zeros( len(minpos), dtype=MINIMUM_FIELDS )
+    mins['index'] = minpos
+    mins['time'] = minpos
+    mins['value'] = minval
+
+    return PeakResult( peaks, mins, bases is not None )
+
+def peakDetectorLoop( v, delta, numnei=-1, basemode='scan' ):
+    """
+    reference engine: the original sample by sample state machine,
+    kept to check the faster engines against. Bases are always found by
+    scanning, basemode is ignored.
+    """
+    maxtab = []
+    mintab = []
+    bases = []
+
+    x = arange(len(v))
+
+    v = asarray(v)
+
+    mn, mx = Inf, -Inf
+    mnpos, mxpos = NaN, NaN
+
+    base = 0
+    basepos = NaN
+
+    lookformax = True
+
+    for i in arange(len(v)):
+        this = v[i]
+        if this > mx:
+            mx = this
+            mxpos = x[i]
+        if this < mn:
+            mn = this
+            mnpos = x[i]
+
+        if lookformax:
+            if this < mx-delta:
+                maxtab.append((mxpos, mx))
+                mn = this
+                mnpos = x[i]
+
+                if numnei > 0:
+                    base,basepos = getLowestInNeighbourhood( v, mxpos, numnei )
+                    bases.append((basepos,base))
+
+                lookformax = False
+
+        else:
+            if this > mn+delta:
+                mintab.append((mnpos, mn))
+                mx = this
+                mxpos = x[i]
+                lookformax = True
+
+    bases = tabArrays( bases ) if numnei > 0 else None
+    return peakResult( tabArrays(maxtab), tabArrays(mintab), bases )
+
+# window sizes (in samples) used by findExtrema when searching forwards
+MIN_WINDOW = 256
+MAX_WINDOW = 1 << 16
+# phases shorter than this (in samples) are quicker stepped through one
+# sample at a time, which findExtrema does in blocks of STEP_BLOCK samples
+SHORT_PHASE = 64
+STEP_BLOCK = 2048
+
+def stepExtrema( values, delta, state, offset, maxtab, mintab ):
+    """
+    findExtrema's state machine a sample at a time over a plain list of
+    floats, appending to maxtab and mintab; quicker than searching in
+    windows when the phases are short.
+
+    returns the new state
+    """
+    lookformax, mx, mxpos, mn, mnpos = state
+    for i, this in enumerate(values, offset):
+        if lookformax:
+            if this > mx:
+                mx = this
+                mxpos = i
+            elif this < mx-delta:
+                maxtab.append((mxpos, mx))
+                mn = this
+                mnpos = i
+                lookformax = False
+        else:
+            if this < mn:
+                mn = this
+                mnpos = i
+            elif this > mn+delta:
+                mintab.append((mnpos, mn))
+                mx = this
+                mxpos = i
+                lookformax = True
+
+    return lookformax, mx, mxpos, mn, mnpos
+
+def findExtrema( v, delta, state=None, offset=0 ):
+    """
+    vectorised form of the state machine in peakDetectorLoop.
+
+    Each phase (looking for a max, or looking for a min) ends at the first
+    sample that drops delta below the running max of the phase (or rises
+    delta above the running min). Rather than stepping through samples we
+    search forwards for that sample in growing windows with a cumulative
+    max/min, so python only does work per peak, not per sample. When the
+    phases get shorter than SHORT_PHASE that per-peak work costs more than
+    the samples, so we step through blocks with stepExtrema until they
+    lengthen again.
+
+    state is (lookformax, mx, mxpos, mn, mnpos) as left by a previous call,
+    offset is added to every position reported.
+
+    returns maxtab, mintab, state
+    """
+    if state is None:
+        state = (True, -Inf, NaN, Inf, NaN)
+    lookformax, mx, mxpos, mn, mnpos = state
+
+    maxtab = []
+    mintab = []
+
+    n = len(v)
+    lo = 0
+    phase = 0
+    window = MIN_WINDOW
+    step = False
+    # NaNs never compare true, just as in the loop
+    with np.errstate(invalid='ignore'):
+        while lo < n:
+            if step:
+                hi = min(n, lo + STEP_BLOCK)
+                before = len(maxtab) + len(mintab)
+                values = asarray(v[lo:hi], dtype=np.float64).tolist()
+                lookformax, mx, mxpos, mn, mnpos = stepExtrema( values, delta,
+                    (lookformax, mx, mxpos, mn, mnpos), offset + lo, maxtab, mintab )
+                # keep stepping while the phases stay short
+                step = (len(maxtab) + len(mintab) - before) * SHORT_PHASE > hi - lo
+                window = MIN_WINDOW
+                lo = phase = hi
+                continue
+
+            hi = min(n, lo + window)
+            # compare in float64 whatever the storage, as the loop does
+            seg = asarray(v[lo:hi], dtype=np.float64)
+
+            # fmax/fmin skip NaNs too
+            if lookformax:
+                run = np.fmax(np.fmax.accumulate(seg), mx)
+                flips = seg < run - delta
+            else:
+                run = np.fmin(np.fmin.accumulate(seg), mn)
+                flips = seg > run + delta
+
+            end = flips.argmax()
+            found = flips[end]
+            if not found:
+                end = len(seg)
+
+            # extreme of the phase so far, first occurrence wins
+            if end > 0:
+                top = run[end-1]
+                if lookformax and top > mx:
+                    mxpos = offset + lo + (seg[:end] == top).argmax()
+                    mx = top
+                elif not lookformax and top < mn:
+                    mnpos = offset + lo + (seg[:end] == top).argmax()
+                    mn = top
+
+            if not found:
+                lo = hi
+                window = min(2*window, MAX_WINDOW)
+                continue
+
+            i = lo + end
+            if lookformax:
+                maxtab.append((mxpos, mx))
+                mn = seg[end]
+                mnpos = offset + i
+                lookformax = False
+            else:
+                mintab.append((mnpos, mn))
+                mx = seg[end]
+                mxpos = offset + i
+                lookformax = True
+
+            # next phase is probably about as long as this one
+            step = i + 1 - phase < SHORT_PHASE
+            window = min(max(MIN_WINDOW, 2*(i + 1 - phase)), MAX_WINDOW)
+            lo = phase = i + 1
+
+    return maxtab, mintab, (lookformax, mx, mxpos, mn, mnpos)
+
+def peakDetectorNumpy( v, delta, numnei=-1, basemode='auto' ):
+    """
+    vectorised engine, gives the same Maxima/Minima/Bases as peakDetectorLoop
+    """
+    v = asarray(v)
+    maxtab, mintab, state = findExtrema( v, delta )
+    maxima = tabArrays( maxtab )
+
+    bases = None
+    if numnei > 0:
+        bases = findBases( v, maxima[0], numnei, basemode )
+
+    return peakResult( maxima, tabArrays(mintab), bases )
+
+def zigzag( values, delta ):
+    """
+    peakDetectorLoop's state machine over a plain list of floats, which is
+    quick for the short sequences sweepExtrema works on.
+
+    returns the indices of the maxima and minima, and of the extreme still
+    being tracked at the end (-1 if none)
+    """
+    maxima = []
+    minima = []
+    mn, mx = Inf, -Inf
+    mnpos, mxpos = -1, -1
+    lookformax = True
+
+    for i, this in enumerate(values):
+        if this > mx:
+            mx = this
+            mxpos = i
+        if this < mn:
+            mn = this
+            mnpos = i
+
+        if lookformax:
+            if this < mx-delta:
+                maxima.append(mxpos)
+                mn = this
+                mnpos = i
+                lookformax = False
+        else:
+            if this > mn+delta:
+                minima.append(mnpos)
+                mx = this
+                mxpos = i
+                lookformax = True
+
+    return maxima, minima, (mxpos if lookformax else mnpos)
+
+def sweepExtrema( v, deltas ):
+    """
+    positions of the maxima findExtrema would give for each of deltas, in
+    little more than the time of one detection.
+
+    The deltas are taken smallest first. Between consecutive maxima and
+    minima found with delta the series never turns back by more than
+    delta, so with any larger delta nothing in there can be a peak or end
+    a phase early - only the maxima, minima, the extreme still being
+    tracked and the two ends of the series matter. Each larger delta is
+    run over just those samples, which get fewer as delta grows.
+
+    returns a list of arrays of positions, one per delta
+    """
+    v = asarray(v)
+    n = len(v)
+    deltas = asarray(deltas, dtype=np.float64)
+
+    found = [ np.zeros(0, dtype=np.int64) for d in deltas ]
+    if n == 0:
+        return found
+
+    pos = None
+    for k in np.argsort(deltas, kind='mergesort'):
+        if pos is None:
+            maxtab, mintab, state = findExtrema( v, deltas[k] )
+            maxima = asarray([ p for p,x in maxtab ], dtype=np.int64)
+            minima = asarray([ p for p,x in mintab ], dtype=np.int64)
+            lookformax, mx, mxpos, mn, mnpos = state
+            last = [ p for p in [ mxpos if lookformax else mnpos ] if p == p ]
+        else:
+            maxima, minima, last = zigzag( values, deltas[k] )
+            maxima = pos[ asarray(maxima, dtype=np.int64) ]
+            minima = pos[ asarray(minima, dtype=np.int64) ]
+            last = [ pos[last] ] if last >= 0 else []
+
+        found[k] = maxima
+        pos = np.union1d( np.union1d(maxima, minima), asarray([0, n-1] + last, dtype=np.int64) )
+        values = asarray(v[pos], dtype=np.float64).tolist()
+
+    return found
+
+# most samples x columns batchExtrema works on at once
+BATCH_ELEMENTS = 1 << 22
+# fewest columns batchExtrema steps through together, fewer are quicker
+# detected one at a time
+BATCH_COLUMNS = 32
+
+def columnExtrema( v, delta, lookformax, ext, extpos, offset, column ):
+    """
+    the rest of one column of batchExtrema, from its state there (ext being
+    -mn when looking for a min), by findExtrema - as a flip record
+    """
+    if lookformax:
+        state = (True, ext, extpos if ext > -Inf else NaN, Inf, NaN)
+    else:
+        state = (False, -Inf, NaN, -ext, extpos)
+    maxtab, mintab, state = findExtrema( v, delta, state, offset )
+    (maxpos, maxval), (minpos, minval) = tabArrays( maxtab ), tabArrays( mintab )
+    return ( np.repeat(column, len(maxpos) + len(minpos)), np.concatenate( (maxpos, minpos) ),
+             np.concatenate( (maxval, minval) ), arange(len(maxpos) + len(minpos)) < len(maxpos) )
+
+def batchExtrema( V, deltas, columns=None ):
+    """
+    findExtrema for every column of the (samples x columns) array V at once,
+    column j using deltas[j] (or the one delta for all). With columns only
+    those columns of V, which is then only read a window of rows at a
+    time.
+
+    All the columns step through the same window of rows together. Within
+    a window a column is 'looking for a max' over its values, or 'looking
+    for a min' over their negatives, so every column runs the same
+    cumulative max search. Columns that flip state go round again from the
+    row after the flip, so python does work per window and per round of
+    flips, never per sample, column or peak.
+
+    That only pays with many columns and sparse peaks: with fewer than
+    BATCH_COLUMNS columns each is detected on its own by findExtrema, and
+    a column averaging phases shorter than SHORT_PHASE over a window is
+    finished on its own by findExtrema, which steps through short phases
+    a sample at a time.
+
+    returns a list of (maxima, minima), one per column, each a pair of
+    arrays of positions and values as from tabArrays
+    """
+    if columns is None:
+        columns = arange(V.shape[1])
+    columns = asarray(columns, dtype=np.int64)
+    n, m = len(V), len(columns)
+    deltas = asarray(deltas, dtype=np.float64) * np.ones(m)
 
-    return int(idx)
+    # the state of each column, with ext the running extreme of the current
+    # phase as seen by the max search: mx, or -mn when looking for a min
+    look = np.ones(m, dtype=bool)
+    ext = np.empty(m)
+    ext.fill(-Inf)
+    extpos = np.zeros(m, dtype=np.int64)
+
+    # every flip as it happens: column, position, value, and whether it
+    # ended a max
+    record = [ (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0, dtype=bool)) ]
+
+    # the columns still stepped through together
+    active = np.ones(m, dtype=bool)
+    if m < BATCH_COLUMNS:
+        active[:] = False
+        for j in range(m):
+            record.append( columnExtrema( V[:,columns[j]], deltas[j], True, -Inf, 0, 0, j ) )
+
+    maxwindow = max(16, min(MAX_WINDOW, BATCH_ELEMENTS // max(m, 1)))
+    window = min(MIN_WINDOW, maxwindow)
+    lo = 0
+    with np.errstate(invalid='ignore'):
+        while lo < n and active.any():
+            hi = min(n, lo + window)
+            h = hi - lo
+            cols = np.flatnonzero(active)
+            # W holds just the active columns, column j at place[j]
+            W = asarray(V[lo:hi][:,columns[cols]], dtype=np.float64)
+            place = np.zeros(m, dtype=np.int64)
+            place[cols] = arange(len(cols))
+            rows = arange(h)[:,None]
+
+            # row each column's current phase starts from within W
+            start = np.zeros(m, dtype=np.int64)
+            rounds = 0
+            counted = len(record)
+            while len(cols):
+                rounds += 1
+                sign = np.where(look[cols], 1.0, -1.0)
+                X = W[:,place[cols]] * sign
+                before = rows < start[cols]
+                X[before] = -Inf
+
+                run = np.fmax(np.fmax.accumulate(X, axis=0), ext[cols])
+                flips = (X < run - deltas[cols]) & ~before
+
+                end = flips.argmax(axis=0)
+                found = flips[end, arange(len(cols))]
+                end[~found] = h
+
+                # extreme of the phase so far, first occurrence wins
+                top = np.where(end > 0, run[np.maximum(end - 1, 0), arange(len(cols))], ext[cols])
+                newer = top > ext[cols]
+                if newer.any():
+                    sub = np.flatnonzero(newer)
+                    first = ((X[:,sub] == top[sub]) & (rows < end[sub])).argmax(axis=0)
+                    extpos[cols[sub]] = lo + first
+                    ext[cols[sub]] = top[sub]
+
+                # record the flips and start the next phase on the row after
+                flipped = cols[found]
+                wasmax = look[flipped]
+                record.append( (flipped, extpos[flipped], np.where(wasmax, ext[flipped], -ext[flipped]), wasmax) )
+                rowsflipped = end[found]
+                look[flipped] = ~look[flipped]
+                ext[flipped] = np.where(look[flipped], 1.0, -1.0) * W[rowsflipped, place[flipped]]
+                extpos[flipped] = lo + rowsflipped
+                start[flipped] = rowsflipped + 1
+                cols = flipped
+
+            # hand the columns with dense peaks over to findExtrema
+            counts = np.bincount( np.concatenate( [ r[0] for r in record[counted:] ] ), minlength=m )
+            for j in np.flatnonzero(active & (counts * SHORT_PHASE > max(h, MIN_WINDOW))):
+                active[j] = False
+                if hi < n:
+                    record.append( columnExtrema( V[hi:,columns[j]], deltas[j], look[j], ext[j], extpos[j], hi, j ) )
+
+            # aim for a couple of rounds per window
+            if rounds > 3:
+                window = max(16, window // 2)
+            elif rounds < 3:
+                window = min(maxwindow, 2*window)
+            lo = hi
+
+    # each column's flips, still in the order they happened
+    column, positions, values, wasmax = [ np.concatenate(part) for part in zip(*record) ]
+    order = np.argsort(column, kind='mergesort')
+    bounds = np.searchsorted(column[order], arange(m + 1))
+    tabs = []
+    for j in range(m):
+        mine = order[bounds[j]:bounds[j+1]]
+        ismax = wasmax[mine]
+        tabs.append( ((positions[mine[ismax]], values[mine[ismax]]),
+                      (positions[mine[~ismax]], values[mine[~ismax]])) )
+    return tabs
+
+def peakDetectorBatch( v, delta, numnei=-1, basemode='auto' ):
+    """
+    the 'batch' engine on its own series, where there is nothing to batch
+    with, so the numpy engine - PeakFinder.Run detects all the series of a
+    file together with detectBatch instead
+    """
+    return peakDetectorNumpy( v, delta, numnei, basemode )
+
+def localMaxima( v ):
+    """
+    positions of the local maxima of v: wherever it turns from rising to
+    falling, at the middle (rounded down) of a flat top. Never the first
+    or last sample, and a NaN breaks a slope.
+    """
+    v = asarray(v, dtype=np.float64)
+    with np.errstate(invalid='ignore'):
+        d = np.diff(v)
+        moves = np.flatnonzero(d != 0)
+        rising = d[moves] > 0
+        falling = d[moves] < 0
+    turns = np.flatnonzero( rising[:-1] & falling[1:] )
+    return (moves[turns] + 1 + moves[turns + 1]) // 2
+
+def valleys( v, positions ):
+    """
+    the lowest sample of v (the first if tied, skipping NaNs) before the
+    first of positions, between each consecutive pair and after the last
+
+    returns arrays of len(positions)+1 positions and values
+    """
+    work = np.array(v, dtype=np.float64)
+    if len(work) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0)
+    work[np.isnan(work)] = Inf
+    starts = np.concatenate( ([0], positions) ).astype(np.int64)
+    lows = np.minimum.reduceat( work, starts )
+
+    # first sample of each stretch that equals its lowest
+    lengths = np.diff( np.concatenate( (starts, [len(work)]) ) )
+    hits = np.flatnonzero( work == np.repeat(lows, lengths) )
+    return hits[ np.searchsorted(hits, starts) ], lows
+
+def sparseTable( x, op ):
+    """
+    levels[k][i] = op over x[i:i+2**k], for range queries with rangeQuery
+    """
+    levels = [ asarray(x) ]
+    step = 1
+    while 2*step <= len(x):
+        prev = levels[-1]
+        levels.append( op(prev[:-step], prev[step:]) )
+        step *= 2
+    return levels
+
+def rangeQuery( levels, op, lo, hi ):
+    """
+    op over x[lo:hi] for arrays of lo < hi, from sparseTable(x, op)
+    """
+    k = np.floor( np.log2(hi - lo) ).astype(np.int64)
+    out = np.empty(len(lo))
+    for level in np.unique(k):
+        sel = k == level
+        table = levels[level]
+        out[sel] = op( table[lo[sel]], table[hi[sel] - (1 << level)] )
+    return out
+
+def nearestHigher( h ):
+    """
+    for each element of h, the index of the nearest element to its left
+    that is strictly higher (h[0] must be higher than everything)
+    """
+    levels = sparseTable( h, np.maximum )
+    pos = arange(len(h))
+    # skip back over the longest run of elements no higher, biggest steps first
+    for level in reversed(range(len(levels))):
+        step = 1 << level
+        can = pos - step >= 0
+        skip = can.copy()
+        skip[can] = levels[level][ pos[can] - step ] <= h[can]
+        pos[skip] -= step
+    return np.maximum(pos - 1, 0)
+
+def prominence( v, peaks ):
+    """
+    prominence of each of peaks (positions from localMaxima): how far it
+    stands above the higher of the lowest points between it and the
+    nearest strictly higher peak on either side, or the end of v
+    """
+    m = len(peaks)
+    if m == 0:
+        return np.zeros(0)
+    heights = asarray(v, dtype=np.float64)[peaks]
+    lowpos, lows = valleys( v, peaks )
+
+    # peaks t = 1..m between sentinels higher than everything, lows[s]
+    # lies between (extended) peaks s and s+1
+    h = np.concatenate( ([Inf], heights, [Inf]) )
+    left = nearestHigher( h )[1:-1]
+    right = (len(h) - 1 - nearestHigher( h[::-1] ))[::-1][1:-1]
+
+    t = arange(1, m + 1)
+    levels = sparseTable( lows, np.minimum )
+    leftmin = rangeQuery( levels, np.minimum, left, t )
+    rightmin = rangeQuery( levels, np.minimum, t, right )
+    return heights - np.maximum(leftmin, rightmin)
+
+def turningResult( v, peaks, numnei, basemode ):
+    """
+    PeakResult for peaks chosen among localMaxima, with the lowest point
+    between each pair of them as the minima
+    """
+    v = asarray(v)
+    values = asarray(v, dtype=np.float64)
+    lowpos, lows = valleys( v, peaks )
+
+    bases = None
+    if numnei > 0:
+        bases = findBases( v, peaks, numnei, basemode )
+    return peakResult( (peaks, values[peaks]), (lowpos[1:-1], lows[1:-1]), bases )
+
+def peakDetectorProminence( v, delta, numnei=-1, basemode='auto' ):
+    """
+    the local maxima with a prominence of at least delta. Unlike the delta
+    hysteresis a peak is judged against the higher peaks around it, so a
+    small bump on the flank of a big peak doesn't count, whatever came
+    before it.
+    """
+    peaks = localMaxima( v )
+    peaks = peaks[ prominence( v, peaks ) >= delta ]
+    return turningResult( v, peaks, numnei, basemode )
+
+def peakDetectorDerivative( v, delta, numnei=-1, basemode='auto' ):
+    """
+    where the first difference of v crosses zero from rising to falling,
+    keeping the peaks more than delta above the lowest point on both sides
+    before the neighbouring crossings. The cheapest engine, but every
+    wiggle is a crossing, so noisy data wants a prefilter.
+    """
+    peaks = localMaxima( v )
+    lowpos, lows = valleys( v, peaks )
+    with np.errstate(invalid='ignore'):
+        keep = asarray(v, dtype=np.float64)[peaks] - np.maximum(lows[:-1], lows[1:]) > delta
+    return turningResult( v, peaks[keep], numnei, basemode )
+
+def smooth( v, kernel ):
+    """
+    v convolved with kernel, centred, the ends padded with the end values
+    so the result is as long as v
+    """
+    v = asarray(v, dtype=np.float64)
+    w = len(kernel)
+    if len(v) == 0:
+        return v
+    padded = np.concatenate( (np.repeat(v[:1], (w - 1) // 2), v, np.repeat(v[-1:], w // 2)) )
+    return np.convolve( padded, kernel[::-1], 'valid' )
+
+def movingAverage( v, width ):
+    """
+    mean of the width samples around each sample
+    """
+    width = int(width)
+    if width < 1:
+        raise ValueError('moving average width must be at least 1, got %d' % width)
+    return smooth( v, np.ones(width) / width )
+
+def savitzkyGolay( v, width, order=2 ):
+    """
+    Savitzky-Golay smoothing: a least squares polynomial of the given order
+    fitted to the width (odd) samples around each sample, taken at the
+    middle one
+    """
+    width, order = int(width), int(order)
+    if width % 2 == 0 or width <= order:
+        raise ValueError('Savitzky-Golay width must be odd and more than the order, got %d, %d' % (width, order))
+    x = arange(width) - width // 2
+    kernel = np.linalg.pinv( np.vander(x, order + 1, increasing=True) )[0]
+    return smooth( v, kernel )
+
+# bytes of CSV text parsed at a time by loadCSV
+CSV_CHUNK = 1 << 24
+
+def countCSV( filename, chunksize=CSV_CHUNK ):
+    """
+    returns (rows, columns) of a CSV file without parsing it, trailing
+    blank lines are not counted
+    """
+    newlines = 0
+    trailing = 0
+    columns = 0
+    content = False
+    f = open(filename, 'rb')
+    try:
+        chunk = f.readline()
+        if chunk:
+            columns = chunk.count(',') + 1
+        while chunk:
+            newlines += chunk.count('\n')
+            text = chunk.rstrip()
+            if text:
+                trailing = chunk.count('\n', len(text))
+                content = True
+            else:
+                trailing += chunk.count('\n')
+            chunk = f.read(chunksize)
+    finally:
+        f.close()
+
+    if not content:
+        return 0, columns
+    return newlines - trailing + 1, columns
+
+def loadCSV( filename, dtype=np.float64, chunksize=CSV_CHUNK, out=None, times=None ):
+    """
+    parses a numeric CSV file straight into a 2-D array, one row per line
+    and one column per field (so column 0 is the timestamps). The array
+    is column-major (Fortran order), so each column is contiguous.
+
+    The file is read chunksize bytes at a time and each chunk is parsed by
+    numpy in C, so memory use is the array itself plus one chunk. Use
+    dtype=numpy.float32 to halve that, though note that column 0 is then
+    only good to ~7 significant figures - pass times, an array of one
+    float64 per row, to have the timestamps kept exactly there as well.
+
+    out, if given, is filled instead of allocating a new array - it must
+    have the shape returned by countCSV.
+    """
+    rows, columns = countCSV( filename, chunksize )
+    if out is None:
+        out = np.empty((rows, columns), dtype=dtype, order='F')
+    elif out.shape != (rows, columns):
+        raise ValueError('%s has shape %s, expected %s' % (filename, (rows, columns), out.shape))
+
+    row = 0
+    tail = ''
+    f = open(filename, 'rb')
+    try:
+        while True:
+            chunk = f.read(chunksize)
+            if chunk:
+                # parse whole lines only, carry the rest on to the next chunk
+                cut = chunk.rfind('\n') + 1
+                if not cut:
+                    tail += chunk
+                    continue
+                text = tail + chunk[:cut]
+                tail = chunk[cut:]
+            else:
+                text = tail
+
+            text = text.replace('\r', '').strip()
+            if text:
+                lines = text.count('\n') + 1
+                values = np.fromstring(text.replace('\n', ','), dtype=np.float64, sep=',')
+                if values.size != lines * columns or row + lines > rows:
+                    raise ValueError('%s: malformed CSV data after line %d' % (filename, row))
+                values = values.reshape(lines, columns)
+                out[row:row+lines] = values
+                if times is not None:
+                    times[row:row+lines] = values[:,0]
+                row += lines
+
+            if not chunk:
+                break
+    finally:
+        f.close()
+
+    if row != rows:
+        raise ValueError('%s: blank lines in CSV data after line %d' % (filename, row))
+    return out
+
+# bump whenever the layout written by convertCSV changes
+CACHE_VERSION = 2
+
+def cachePaths( filename, dtype ):
+    """
+    the .npy file, timestamps .npy file (None when dtype is float64, which
+    holds them exactly already) and key file that cache a CSV file
+    converted to dtype
+    """
+    name = np.dtype(dtype).name
+    stem = '%s.%s.cache' % (filename, name)
+    timesname = None
+    if np.dtype(dtype) != np.float64:
+        timesname = '%s.%s.times.cache.npy' % (filename, name)
+    return stem + '.npy', timesname, stem + '.key'
+
+def cacheKey( filename, dtype ):
+    """
+    identifies one version of a CSV file, a cache is only valid while its
+    key file still holds this
+    """
+    st = os.stat(filename)
+    return '%d %r %d %r %s\n' % (CACHE_VERSION, os.path.abspath(filename), st.st_size, st.st_mtime, np.dtype(dtype).name)
+
+def convertCSV( filename, npyname, dtype=np.float64, timesname=None ):
+    """
+    converts a CSV file into a column-major .npy file which can be memory
+    mapped, the CSV is parsed straight into the mapped file so it never
+    has to fit in memory. With timesname the timestamps are written there
+    too, as float64.
+    """
+    rows, columns = countCSV( filename )
+    names = [ npyname ]
+    out = np.lib.format.open_memmap(npyname + '.tmp', mode='w+', dtype=dtype, shape=(rows, columns), fortran_order=True)
+    times = None
+    if timesname is not None:
+        names.append( timesname )
+        times = np.lib.format.open_memmap(timesname + '.tmp', mode='w+', dtype=np.float64, shape=(rows,))
+    try:
+        loadCSV( filename, dtype, out=out, times=times )
+        out.flush()
+        if times is not None:
+            times.flush()
+    except:
+        del out, times
+        for name in names:
+            os.remove(name + '.tmp')
+        raise
+    del out, times
+    for name in names:
+        if os.path.exists(name):
+            os.remove(name)
+        os.rename(name + '.tmp', name)
+
+def parseTraces( filename, dtype=np.float64 ):
+    """
+    loadTraces without the cache: the CSV parsed into memory
+    """
+    if np.dtype(dtype) == np.float64:
+        block = loadCSV( filename, dtype )
+        return block[:,0], block
+    rows, columns = countCSV( filename )
+    block = np.empty((rows, columns), dtype=dtype, order='F')
+    times = np.empty(rows)
+    loadCSV( filename, dtype, out=block, times=times )
+    return times, block
+
+def mapTraces( npyname, timesname=None ):
+    """
+    loadTraces of a cache written by convertCSV
+    """
+    block = np.load(npyname, mmap_mode='r')
+    if timesname is None:
+        return block[:,0], block
+    return np.load(timesname, mmap_mode='r'), block
+
+def loadTraces( filename, dtype=np.float64, cache=True, parse=True ):
+    """
+    the timestamps of a trace file, always float64, and its (rows x
+    columns) array, column 0 being the timestamps again in dtype. CSV
+    files give a column-major array, so that every series is contiguous.
+
+    .npy files are memory mapped, so slicing them reads only what is used.
+    CSV files are converted to .npy next to the CSV the first time they are
+    seen (cache=True) and mapped from there, until the CSV's size or mtime
+    changes. If the cache can't be written the CSV is just parsed - or,
+    with parse=False, for callers that can't hold it all in memory,
+    ValueError is raised.
+    """
+    if filename.endswith('.npy'):
+        block = np.load(filename, mmap_mode='r')
+        return asarray(block[:,0], dtype=np.float64), block
+
+    if not cache:
+        if not parse:
+            raise ValueError('%s would have to be parsed into memory, turn on its .npy cache' % filename)
+        return parseTraces( filename, dtype )
+
+    npyname, timesname, keyname = cachePaths( filename, dtype )
+    key = cacheKey( filename, dtype )
+    try:
+        f = open(keyname)
+        try:
+            valid = f.read() == key
+        finally:
+            f.close()
+        if valid:
+            return mapTraces( npyname, timesname )
+    except (IOError, OSError, ValueError):
+        pass
+
+    try:
+        convertCSV( filename, npyname, dtype, timesname )
+        f = open(keyname, 'w')
+        f.write(key)
+        f.close()
+    except (IOError, OSError), err:
+        if not parse:
+            raise ValueError('%s would have to be parsed into memory, its .npy cache could not be written: %s' % (filename, err))
+        return parseTraces( filename, dtype )
+
+    return mapTraces( npyname, timesname )
+
+class StreamingPeakDetector:
+    """
+    PeakDetector for unbounded input, fed a chunk at a time with push().
+
+    The state machine (lookformax, mx, mxpos, mn, mnpos) is carried from
+    one chunk to the next, and maxima and minima are returned as soon as
+    they are confirmed, with positions counted from the first sample ever
+    pushed. A peak's base needs numnei samples after it, so bases are
+    returned once those have arrived (or by close(), at the end of the
+    stream).
+
+    Only the last numnei samples are kept, plus a running minimum for each
+    peak still waiting for its base, so memory does not grow with the
+    length of the stream. Pushing a whole series and then calling close()
+    gives exactly what PeakDetector gives.
+    """
+    def __init__( self, delta, numnei=-1 ):
+        self.delta = delta
+        self.numnei = numnei
+
+        self.lookformax = True
+        self.mn, self.mx = Inf, -Inf
+        self.mnpos, self.mxpos = NaN, NaN
+
+        # samples pushed so far, and the last numnei of them
+        self.count = 0
+        self.recent = np.empty(0)
+
+        # [peak, lowest, lowest_idx, next sample to look at, end of window]
+        # for confirmed peaks waiting for their base, and for the peak
+        # currently being looked for
+        self.pending = deque()
+        self.candidate = None
+
+    def push( self, chunk ):
+        """
+        feeds the next chunk of samples, returns what it confirmed as
+        {'Maxima':..., 'Minima':..., 'Bases':...}
+        """
+        chunk = asarray(chunk)
+        state = (self.lookformax, self.mx, self.mxpos, self.mn, self.mnpos)
+        maxtab, mintab, state = findExtrema( chunk, self.delta, state, self.count )
+        self.lookformax, self.mx, self.mxpos, self.mn, self.mnpos = state
+
+        bases = []
+        if self.numnei > 0:
+            bases = self.FindBases( chunk, maxtab )
+
+        self.count += len(chunk)
+        return {'Maxima':maxtab,'Minima':mintab, 'Bases':bases}
+
+    def close( self ):
+        """
+        ends the stream, returns the bases still outstanding - their
+        windows are clipped at the last sample like PeakDetector's
+        """
+        bases = [ (t[2], t[1]) for t in self.pending ]
+        self.pending = deque()
+        self.candidate = None
+        return {'Maxima':[],'Minima':[], 'Bases':bases}
+
+    def FindBases( self, chunk, maxtab ):
+        # samples from wstart onwards, NaN as +Inf as in SlidingMinimum
+        work = np.concatenate( (self.recent, asarray(chunk, dtype=np.float64)) )
+        work[np.isnan(work)] = Inf
+        wstart = self.count - len(self.recent)
+        end = self.count + len(chunk)
+
+        for t in self.pending:
+            self.Fold( t, work, wstart, end )
+
+        for mxpos, mx in maxtab:
+            if self.candidate is not None and self.candidate[0] == mxpos:
+                t = self.candidate
+            else:
+                t = self.NewTracker( mxpos )
+            self.candidate = None
+            self.Fold( t, work, wstart, end )
+            self.pending.append( t )
+
+        # keep the window of the peak being looked for up to date, its
+        # left half is about to drop out of self.recent
+        if self.lookformax and not np.isnan(self.mxpos):
+            if self.candidate is None or self.candidate[0] != self.mxpos:
+                self.candidate = self.NewTracker( self.mxpos )
+            self.Fold( self.candidate, work, wstart, end )
+
+        bases = []
+        while self.pending and self.pending[0][3] >= self.pending[0][4]:
+            t = self.pending.popleft()
+            bases.append( (t[2], t[1]) )
+
+        self.recent = work[max(0, len(work) - self.numnei):]
+        return bases
+
+    def NewTracker( self, mxpos ):
+        lo = max(mxpos - self.numnei, 0)
+        return [ mxpos, Inf, lo, lo, mxpos + self.numnei ]
+
+    def Fold( self, t, work, wstart, end ):
+        hi = min(t[4], end)
+        if hi > t[3]:
+            seg = work[t[3] - wstart:hi - wstart]
+            j = seg.argmin()
+            if seg[j] < t[1]:
+                t[1] = seg[j]
+                t[2] = t[3] + j
+            t[3] = hi
+
+# implementations of PeakDetector, selected by PeakFinder(engine=...)
+ENGINES = { 'billauer':   peakDetectorNumpy,
+            'numpy':      peakDetectorNumpy,
+            'loop':       peakDetectorLoop,
+            'prominence': peakDetectorProminence,
+            'derivative': peakDetectorDerivative,
+            'batch':      peakDetectorBatch }
+
+# the engines that give the same results, the delta hysteresis
+BILLAUER_ENGINES = ('billauer', 'numpy', 'loop', 'batch')
+
+# smoothing applied before detection, selected by PeakFinder(prefilter=...)
+# as 'name:arg:arg'
+PREFILTERS = { 'mean':   movingAverage,
+               'savgol': savitzkyGolay }
+
+def parsePrefilter( spec ):
+    """
+    'savgol:11:3' -> ('savgol', 11, 3); None or 'none' -> None
+    """
+    if spec is None or spec in ('', 'none'):
+        return None
+    if not isinstance(spec, basestring):
+        return tuple(spec)
+    parts = spec.split(':')
+    if parts[0] not in PREFILTERS:
+        raise ValueError('unknown prefilter %s, expected one of %s' % (parts[0], ', '.join(sorted(PREFILTERS))))
+    try:
+        return (parts[0],) + tuple( int(p) for p in parts[1:] )
+    except ValueError:
+        raise ValueError('bad prefilter %s, expected name:width[:order]' % spec)
+
+def detect( v, delta, numnei, engine, basemode, prefilter=None, timings=None, series=0 ):
+    """
+    v smoothed by prefilter (from parsePrefilter), then ENGINES[engine].
+    Given timings (see Timings), the smoothing, detection and base search
+    are timed as the stages prefilter, detect and bases of series.
+    """
+    if timings is not None:
+        return detectStages( v, delta, numnei, engine, basemode, prefilter, timings, series )
+    if prefilter is not None:
+        v = PREFILTERS[prefilter[0]]( v, *prefilter[1:] )
+    return ENGINES[engine]( v, delta, numnei, basemode )
+
+def detectStages( v, delta, numnei, engine, basemode, prefilter, timings, series ):
+    """
+    detect, one stage at a time: the engine runs without bases, and
+    findBases adds them after - which gives the same result
+    """
+    if prefilter is not None:
+        with timings.Stage( 'prefilter', series, len(v) ):
+            v = PREFILTERS[prefilter[0]]( v, *prefilter[1:] )
+
+    with timings.Stage( 'detect', series, len(v) ) as stage:
+        result = ENGINES[engine]( v, delta, -1, basemode )
+        stage.peaks = len(result)
+
+    if numnei > 0:
+        # the loop engine always scans
+        mode = 'scan' if engine == 'loop' else basemode
+        with timings.Stage( 'bases', series, len(v) ) as stage:
+            peaks = result.peaks
+            peaks['base_index'], peaks['base_value'] = findBases( v, peaks['index'], numnei, mode )
+            peaks['delta'] = peaks['value'] - peaks['base_value']
+            result.has_bases = True
+            stage.peaks = len(result)
+    return result
+
+def detectChunked( v, delta, numnei, chunk, timings=None, series=0 ):
+    """
+    the delta hysteresis over v read chunk samples at a time, through a
+    StreamingPeakDetector - so with v memory mapped only about a chunk of
+    it has to be in memory at once, however long it is. Gives the same
+    PeakResult as detecting the whole of v.
+    """
+    return detectRows( asarray(v)[:,np.newaxis], [0], delta, numnei, chunk, timings, series )[0]
+
+def detectRows( block, columns, delta, numnei, chunk, timings=None, series=0 ):
+    """
+    detectChunked for several columns of block at once, walking down it
+    chunk rows at a time with a StreamingPeakDetector per column - so a
+    memory mapped file is read once, in order.
+
+    returns a PeakResult per column
+    """
+    if timings is None:
+        timings = NoTimings()
+    detectors = [ StreamingPeakDetector( delta, numnei ) for column in columns ]
+    found = [ { 'Maxima': [], 'Minima': [], 'Bases': [] } for column in columns ]
+
+    with timings.Stage( 'detect', series, len(block) * len(columns) ) as stage:
+        for lo in xrange(0, len(block), chunk):
+            rows = block[lo:lo+chunk]
+            for column, detector, tabs in zip(columns, detectors, found):
+                for key, tab in detector.push( rows[:,column] ).items():
+                    tabs[key].append( tabArrays( tab ) )
+
+        results = []
+        for detector, tabs in zip(detectors, found):
+            for key, tab in detector.close().items():
+                tabs[key].append( tabArrays( tab ) )
+            joined = {}
+            for key, parts in tabs.items():
+                positions, values = zip(*parts)
+                joined[key] = np.concatenate(positions), np.concatenate(values)
+            results.append( peakResult( joined['Maxima'], joined['Minima'], joined['Bases'] if numnei > 0 else None ) )
+        stage.peaks = sum(map(len, results))
+    return results
+
+def detectBatch( block, columns, delta, numnei, basemode='auto', timings=None, series=0 ):
+    """
+    the delta hysteresis over several columns of block together, stepping
+    all of them through each window of rows at once with batchExtrema -
+    so the python overhead is per window of rows, not per window of each
+    column. Bases are found a column at a time by findBases.
+
+    returns a PeakResult per column, the same as detecting each alone
+    """
+    if timings is None:
+        timings = NoTimings()
+    with timings.Stage( 'detect', series, len(block) * len(columns) ) as stage:
+        tabs = batchExtrema( block, delta, columns )
+        stage.peaks = sum( len(maxima[0]) for maxima, minima in tabs )
+
+    results = []
+    for column, (maxima, minima) in zip(columns, tabs):
+        bases = None
+        if numnei > 0:
+            with timings.Stage( 'bases', column, len(block) ) as stage:
+                bases = findBases( block[:,column], maxima[0], numnei, basemode )
+                stage.peaks = len(maxima[0])
+        results.append( peakResult( maxima, minima, bases ) )
+    return results
+
+# how findBases searches for bases, selected by PeakFinder(basemode=...)
+BASE_MODES = ('auto', 'scan', 'window')
+
+def writeNpz( filename, tables ):
+    """
+    writes tables (name -> structured array) as one array per column,
+    named table.column, to an uncompressed .npz
+    """
+    columns = {}
+    for name, table in tables.items():
+        for field in table.dtype.names:
+            columns['%s.%s' % (name, field)] = table[field]
+    f = open(filename, 'wb')
+    try:
+        np.savez( f, **columns )
+    finally:
+        f.close()
+
+def writeJSONLines( filename, tables ):
+    """
+    writes tables (name -> structured array) as one JSON object per row,
+    with a "table" member naming the table it came from. NaN and Inf are
+    written as null.
+    """
+    lines = []
+    for name, table in tables.items():
+        fields = table.dtype.names
+
+        # each column formatted as a whole, then one % per row
+        columns = []
+        for field in fields:
+            if table[field].dtype.kind in 'SU':
+                values = map( json.dumps, table[field].tolist() )
+            else:
+                values = map( repr, table[field].tolist() )
+            if table[field].dtype.kind == 'f':
+                bad = np.flatnonzero( ~np.isfinite(table[field]) )
+                for j in bad:
+                    values[j] = 'null'
+            columns.append( values )
+        template = '{' + ', '.join( [ '"table": %s' % json.dumps(name) ] + [ '%s: %%s' % json.dumps(field) for field in fields ] ) + '}\n'
+        lines.extend( template % row for row in zip(*columns) )
+
+    f = open(filename, 'w')
+    try:
+        f.write( ''.join(lines) )
+    finally:
+        f.close()
+
+# output writers, selected by PeakFinder.Write(format=...) or the extension
+OUTPUT_FORMATS = { 'npz':   writeNpz,
+                   'jsonl': writeJSONLines }
+
+class ResultCache:
+    """
+    the most recently used PeakDetector results, keyed by whatever
+    identifies the inputs - PeakFinder uses (hash of the series, start,
+    stop, delta, numnei). Holds at most size results, dropping the least
+    recently used, and counts hits and misses.
+
+    Given a filename the cache is loaded from it, and Save() writes it back,
+    so results survive from one run to the next. The file holds each result
+    as a plain (peaks, minima, has_bases) tuple, so it loads whether
+    PeakFinder was imported or run as a script.
+    """
+    def __init__( self, size=1024, filename=None ):
+        self.size = size
+        self.filename = filename
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.dirty = False
+
+        if filename is not None and os.path.exists(filename):
+            self.Load()
+
+    def Get( self, key ):
+        """
+        the result for key, or None
+        """
+        result = self.entries.pop(key, None)
+        if result is None:
+            self.misses += 1
+            return None
+        self.entries[key] = result
+        self.hits += 1
+        return result
+
+    def Put( self, key, result ):
+        self.entries.pop(key, None)
+        self.entries[key] = result
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        self.dirty = True
+
+    def Load( self ):
+        """
+        reads the cache file, starting empty (with a warning) if it can't
+        be read
+        """
+        try:
+            f = open(self.filename, 'rb')
+            try:
+                entries = [ (key, PeakResult( *state )) for key, state in pickle.load(f) ]
+            finally:
+                f.close()
+        except Exception, err:
+            print >> sys.stderr, 'Warning: ignoring result cache %s (%s: %s)' % (self.filename, type(err).__name__, err)
+            entries = []
+        for key, result in entries:
+            self.Put( key, result )
+        self.dirty = False
+
+    def Save( self ):
+        """
+        writes the cache to its file, if it has one and anything changed
+        """
+        if self.filename is None or not self.dirty:
+            return
+        tmpname = self.filename + '.tmp'
+        f = open(tmpname, 'wb')
+        try:
+            pickle.dump([ (key, result.__getstate__()) for key, result in self.entries.items() ], f, pickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+        os.rename(tmpname, self.filename)
+        self.dirty = False
+
+    def Stats( self ):
+        return '%d results cached, %d hits, %d misses' % (len(self.entries), self.hits, self.misses)
+
+def maxResidentMB():
+    """
+    the most this process has ever had resident, in MB, from getrusage
+    (0 where there is no resource module, as on windows)
+    """
+    try:
+        import resource
+    except ImportError:
+        return 0.0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, KB elsewhere
+    if sys.platform == 'darwin':
+        return rss / 1048576.0
+    return rss / 1024.0
+
+def residentMB():
+    """
+    resident set size of this process now, in MB (linux only, elsewhere
+    maxResidentMB, so that a stage shows how far it raised the peak)
+    """
+    try:
+        f = open('/proc/self/statm')
+        try:
+            pages = int(f.read().split()[1])
+        finally:
+            f.close()
+        return pages * os.sysconf('SC_PAGE_SIZE') / 1048576.0
+    except (IOError, OSError, ValueError, AttributeError):
+        return maxResidentMB()
+
+def resetPeakMemory():
+    """
+    restarts the count peakMemoryMB reports (linux only, where it isn't
+    possible the peak is the process's peak so far)
+    """
+    try:
+        f = open('/proc/self/clear_refs', 'w')
+        try:
+            f.write('5')
+        finally:
+            f.close()
+    except (IOError, OSError):
+        pass
+
+def peakMemoryMB():
+    """
+    the most this process has had resident since resetPeakMemory, in MB
+    """
+    try:
+        f = open('/proc/self/status')
+    except (IOError, OSError):
+        f = []
+    try:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) / 1024.0
+    finally:
+        if f:
+            f.close()
+    return maxResidentMB()
+
+class Stage:
+    """
+    one timed stage of Timings, see Timings.Stage. Set peaks before the
+    stage ends to record how many it found.
+    """
+    def __init__( self, timings, name, series, samples ):
+        self.timings = timings
+        self.name = name
+        self.series = series
+        self.samples = samples
+        self.peaks = 0
+        self.peak_mb = 0.0
+
+    def __enter__( self ):
+        stack = self.timings.stack
+        if stack:
+            # the enclosing stage's peak so far, before it is reset
+            stack[-1].peak_mb = max(stack[-1].peak_mb, peakMemoryMB())
+        stack.append( self )
+        self.base_mb = residentMB()
+        resetPeakMemory()
+        self.start = time.time()
+        return self
+
+    def __exit__( self, kind, value, tb ):
+        seconds = time.time() - self.start
+        stack = self.timings.stack
+        stack.pop()
+        self.peak_mb = max(self.peak_mb, peakMemoryMB())
+        if stack:
+            stack[-1].peak_mb = max(stack[-1].peak_mb, self.peak_mb)
+        if kind is None:
+            self.timings.Add( self.name, self.series, 1, seconds, self.samples, self.peaks,
+                              max(0.0, self.peak_mb - self.base_mb) )
+
+class Timings:
+    """
+    what each stage of a PeakFinder cost, per series (0 for the stages
+    that cover them all): calls, wall time, samples gone through, peaks
+    found and MB allocated, measured as how far the process's peak
+    resident memory rose above where it was when the stage began. Only
+    linux can say that; elsewhere MB is how far the stage raised the
+    peak of the whole run so far, often 0.
+
+    Stages are timed with
+
+        with timings.Stage( 'detect', series, samples ) as stage:
+            ...
+            stage.peaks = len(result)
+
+    and add up over repeated calls until Clear().
+    """
+    def __init__( self ):
+        self.stages = OrderedDict()
+        self.stack = []
+
+    def Stage( self, name, series=0, samples=0 ):
+        return Stage( self, name, series, samples )
+
+    def Add( self, name, series, calls, seconds, samples, peaks, mb ):
+        row = self.stages.setdefault( (name, series), [0, 0.0, 0, 0, 0.0] )
+        row[0] += calls
+        row[1] += seconds
+        row[2] += samples
+        row[3] += peaks
+        row[4] = max(row[4], mb)
+
+    def Merge( self, stages ):
+        """
+        adds the stages of another Timings, e.g. from a pool worker
+        """
+        for (name, series), row in stages.items():
+            self.Add( name, series, *row )
+
+    def Clear( self ):
+        self.stages = OrderedDict()
+
+    def Totals( self ):
+        """
+        (stage, calls, seconds, samples, peaks, MB) for each stage over all
+        the series, in the order they first ran
+        """
+        totals = OrderedDict()
+        for (name, series), row in self.stages.items():
+            total = totals.setdefault( name, [0, 0.0, 0, 0, 0.0] )
+            for j in range(4):
+                total[j] += row[j]
+            total[4] = max(total[4], row[4])
+        return [ (name,) + tuple(row) for name, row in totals.items() ]
+
+    def Line( self ):
+        """
+        the time of each stage on one line, for a status bar
+        """
+        return '  '.join( '%s %.3fs' % (name, seconds) for name, calls, seconds, samples, peaks, mb in self.Totals() )
+
+    def Print( self ):
+        print "%12s\t%8s\t%8s\t%10s\t%10s\t%12s\t%8s\t%8s" % ('Stage','Series','Calls','Seconds','Samples','Samples/s','Peaks','MB')
+        rows = [ (name, series) + tuple(row) for (name, series), row in self.stages.items() ]
+        rows += [ (total[0], 'all') + total[1:] for total in self.Totals() ]
+        for name, series, calls, seconds, samples, peaks, mb in rows:
+            rate = samples / seconds if samples and seconds > 0 else NaN
+            print "%12s\t%8s\t%8d\t%10.4f\t%10d\t%12.4g\t%8d\t%8.1f" % (name, series, calls, seconds, samples, rate, peaks, mb)
+
+class NoTimings:
+    """
+    stands in for Timings when they're off, at the cost of a call per stage
+    """
+    stages = OrderedDict()
+
+    def Stage( self, name, series=0, samples=0 ):
+        return NO_STAGE
+
+    def Merge( self, stages ):
+        pass
+
+    def Clear( self ):
+        pass
+
+    def Totals( self ):
+        return []
+
+    def Line( self ):
+        return ''
+
+    def Print( self ):
+        pass
+
+class NoStage:
+    """
+    the stage NoTimings hands out, which records nothing
+    """
+    peaks = 0
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, kind, value, tb ):
+        pass
+
+NO_STAGE = NoStage()
+
+# part of every DetectionKey, so that cached results of an older layout
+# are never used
+RESULT_VERSION = 2
+
+# the (samples x columns) block each pool worker detects peaks in
+workerBlock = None
+
+def breakNames( count ):
+    """
+    labels for count segment boundaries: A, B, C, ... or 1, 2, 3, ... when
+    there are more than letters
+    """
+    if count <= 26:
+        return [ chr(ord('A') + k) for k in range(count) ]
+    return [ str(k+1) for k in range(count) ]
+
+def sharedBlock( block ):
+    """
+    describes block so pool workers can get at it without it being pickled:
+    memory mapped files are just mapped again by each worker, anything else
+    is copied once into shared memory
+    """
+    if isinstance(block, np.memmap) and block.filename is not None and block.base is not None:
+        order = 'F' if np.isfortran(block) else 'C'
+        return ('memmap', block.filename, block.offset, block.shape, block.dtype.str, order)
+
+    order = 'F' if np.isfortran(block) else 'C'
+    raw = RawArray('b', block.nbytes)
+    shared = np.frombuffer(raw, dtype=block.dtype).reshape(block.shape, order=order)
+    shared[...] = block
+    return ('shared', raw, block.shape, block.dtype.str, order)
+
+def initWorker( source ):
+    global workerBlock
+    if source[0] == 'memmap':
+        kind, filename, offset, shape, dtype, order = source
+        workerBlock = np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=shape, order=order)
+    else:
+        kind, raw, shape, dtype, order = source
+        workerBlock = np.frombuffer(raw, dtype=dtype).reshape(shape, order=order)
+
+def detectTask( task ):
+    """
+    runs one PeakDetector job in a pool worker - timed, it returns the
+    stages of its Timings with the result
+    """
+    column, start, stop, delta, numnei, engine, basemode, prefilter, chunk, timed = task
+    timings = Timings() if timed else None
+    if chunk:
+        result = detectChunked( workerBlock[start:stop, column], delta, numnei, chunk, timings, column )
+    else:
+        result = detect( workerBlock[start:stop, column], delta, numnei, engine, basemode, prefilter, timings, column )
+    if timed:
+        return result, timings.stages
+    return result
+
+def envelope( times, data, bins ):
+    """
+    data reduced to the lowest and highest value in each of about bins
+    equal runs of samples, as x, y to plot: a vertical stroke per run,
+    which at one run per pixel looks the same as plotting every sample.
+    Fewer than 2*bins samples are returned as they are.
+    """
+    n = len(data)
+    if n <= 2*bins:
+        return times, data
+
+    edges = arange(0, n, -(-n // bins))
+    data = asarray(data, dtype=np.float64)
+    # fmin/fmax skip NaNs, a run of only NaNs is left as a gap
+    with np.errstate(invalid='ignore'):
+        lows = np.fmin.reduceat( data, edges )
+        highs = np.fmax.reduceat( data, edges )
+
+    x = np.repeat( asarray(times[edges], dtype=np.float64), 2 )
+    y = np.empty( 2*len(edges) )
+    y[0::2] = lows
+    y[1::2] = highs
+    return x, y
+
+class DecimatedLine:
+    """
+    times, data plotted on ax as their envelope at about the pixel width
+    of ax, worked out again for just the visible samples whenever the x
+    limits change (zooming or panning), so only those are ever touched
+    at full resolution.
+
+    matplotlib only keeps a weak reference to the callback, so whoever
+    makes a DecimatedLine has to hold on to it.
+    """
+    def __init__( self, ax, times, data, **kwargs ):
+        self.ax = ax
+        self.times = times
+        self.data = data
+        x, y = envelope( times, data, self.Bins() )
+        self.line, = ax.plot( x, y, **kwargs )
+        ax.callbacks.connect( 'xlim_changed', self.OnXlimChanged )
+
+    def Bins( self ):
+        return max( 100, int(self.ax.get_window_extent().width) )
+
+    def OnXlimChanged( self, ax ):
+        xmin, xmax = sorted( ax.get_xlim() )
+        # one sample either side, so the line runs off the edges
+        lo = max( 0, np.searchsorted(self.times, xmin, side='left') - 1 )
+        hi = min( len(self.times), np.searchsorted(self.times, xmax, side='right') + 1 )
+        x, y = envelope( self.times[lo:hi], self.data[lo:hi], self.Bins() )
+        self.line.set_data( x, y )
 
 class PeakFinder:
-    def __init__( self, csv, delta, numnei, a, b, c ):
+    def __init__( self, csv, delta, numnei, a, b, c, engine='numpy', basemode='auto', dtype=np.float64, cache=True, compat_indices=True, workers=1, segments=None, cache_size=1024, result_cache=None, prefilter=None, timings=False, profile=None, chunk=None ):
+
+        if basemode not in BASE_MODES:
+            raise ValueError('unknown base mode %s, expected one of %s' % (basemode, ', '.join(BASE_MODES)))
+        if chunk is not None and chunk < 1:
+            raise ValueError('chunk must be at least one row, got %s' % chunk)
+        # rows of a series detected at a time (see detectChunked), or None
+        # for whole series
+        self.chunk = chunk
+        self.SetEngine( engine, prefilter )
+        self.basemode = basemode
+        # what each stage costs (see Timings), and where Run writes a
+        # cProfile of itself - both off by default
+        self.Timings = Timings() if timings else NoTimings()
+        self.profile = profile
+        self.dtype = dtype
+        self.cache = cache
+        self.compat_indices = compat_indices
+        # more than one runs the detection in a process pool
+        self.workers = workers or multiprocessing.cpu_count()
+        self.Shared = None
+        # whole series PeakDetector results, see DetectionKey
+        self.Detections = ResultCache( cache_size, result_cache )
+        self.SeriesHashes = {}
 
         self.Times,self.Data = self.ParseDataFromCSV( csv )
         self.delta = delta
         self.numnei = numnei
         self.Results = []
+        # what Plot drew last, for UpdatePlot
+        self.Plotted = None
 
-        self.A,self.B,self.C = self.ConvertTimesToIndices( a,b,c )
+        self.SetBreaks( segments or [a,b,c] )
+
+    def SetEngine( self, engine, prefilter=None ):
+        """
+        picks the detector from ENGINES, and the smoothing applied first
+        (see parsePrefilter)
+        """
+        if engine not in ENGINES:
+            raise ValueError('unknown engine %s, expected one of %s' % (engine, ', '.join(sorted(ENGINES))))
+        prefilter = parsePrefilter( prefilter )
+        if self.chunk is not None and (engine not in BILLAUER_ENGINES or prefilter is not None):
+            raise ValueError('chunked detection needs one of the engines %s and no prefilter' % ', '.join(BILLAUER_ENGINES))
+        self.engine = engine
+        self.prefilter = prefilter
 
     def OnNewFile( self, csv ):
         self.Times,self.Data = self.ParseDataFromCSV( csv )
+        self.SeriesHashes = {}
+
 
+    def ConvertTimesToBreaks( self, times ):
+        """
+        converts segment boundary times to indices into self.Times
+        """
+        # if later boundaries haven't been specified then just parse the whole file
+        times = list(times)
+        for k in range(1, len(times)):
+            if times[k] == 0:
+                times[k] = self.Times[len(self.Times) - 1]
 
-    def ConvertTimesToIndices( self, a,b,c ):
-        #print( "a,b,c=",a,b,c)
-        # if b,c haven't been specified then just parse the whole file
-        self.a_time = int(a)
-        self.b_time = int(b)
-        self.c_time = int(c)
-        if b == 0:
-            b = self.Times[len(self.Times) - 1]
+        # conert times to idx values
+        with self.Timings.Stage( 'indices', 0, len(self.Times) ):
+            return [ int(i) for i in valToIdx( times, self.Times, self.compat_indices ) ]
 
-        if c == 0:
-            #print('c==0 len(times=',len(times),times)
-            c = self.Times[len(self.Times) - 1]
+    def SetBreaks( self, times ):
+        """
+        splits the data into len(times)-1 segments, between each pair of
+        consecutive boundary times. A,B,C are kept as the first three
+        boundaries, which is all there are unless segments= was given.
+        """
+        if len(times) < 2:
+            raise ValueError('need at least two segment boundaries, got %s' % list(times))
+        self.BreakTimes = [ int(t) for t in times ]
+        self.Breaks = self.ConvertTimesToBreaks( times )
+        padded = self.Breaks + [ self.Breaks[-1] ] * 2
+        self.A, self.B, self.C = padded[:3]
 
-        # conert a,b,c to idx values
-        return valToIdx(a,self.Times), valToIdx(b,self.Times), valToIdx(c,self.Times)
+    def Reset( self, delta, numnei, a, b, c, segments=None, progress=None ):
+        """
+        runs again with new parameters and segment boundaries. If that
+        fails or is abandoned (see Run) the finder is left as it was,
+        parameters, boundaries and Results together.
+        """
+        state = (self.delta, self.numnei, self.BreakTimes, self.Breaks, self.A, self.B, self.C)
+        try:
+            self.delta = delta
+            self.numnei = numnei
+            self.SetBreaks( segments or [a,b,c] )
+            self.Run( progress )
+        except:
+            self.delta, self.numnei, self.BreakTimes, self.Breaks, self.A, self.B, self.C = state
+            raise
 
-    def Reset( self, delta, numnei, a, b, c ):
-        self.delta = delta
-        self.numnei = numnei
-        self.A, self.B, self.C = self.ConvertTimesToIndices( a,b,c ) 
-        self.Results = []
-        self.Run()
+    def Run( self, progress=None ):
+        """
+        detects peaks once over each whole series, then splits them up into
+        the segments - Results[i][k] is series i, segment k, with positions
+        relative to the start of the segment.
 
-    def Run( self ):
-        self.Results = []
-        for i in arange(len(self.Data)):
-            self.Results.append([])
-            self.Results[i].append( self.PeakDetector( self.Data[i][self.A:self.B], self.delta, self.numnei) )
-            self.Results[i].append( self.PeakDetector( self.Data[i][self.B:self.C], self.delta, self.numnei) )
+        Because the detection sees the whole series, a segment's results
+        are not what detecting that segment on its own would give: a base
+        may lie across a segment boundary, and there is no spurious peak
+        at the start of a segment that begins on a falling edge.
+
+        Detections are kept in a ResultCache, so when only the segment
+        boundaries change (as from the GUI), or a delta/numnei is revisited,
+        nothing is detected again and the cost is just splitting the known
+        peaks.
+
+        progress, if given, is called as progress(done, total) with the
+        number of series finished so far, before each one and at the end.
+        It may raise to abandon the run, leaving Results as they were.
+
+        With a profile filename the whole run is profiled with cProfile,
+        the stats written there (see pstats).
+        """
+        if self.profile is None:
+            return self.RunStages( progress )
+
+        import cProfile
+        profiler = cProfile.Profile()
+        try:
+            profiler.runcall( self.RunStages, progress )
+        finally:
+            profiler.dump_stats( self.profile )
+
+    def RunStages( self, progress=None ):
+        timings = self.Timings
+        with timings.Stage( 'run', 0, self.Data.size ) as stage:
+            if self.workers > 1:
+                self.RunParallel( progress )
+            elif self.chunk is not None or (self.engine == 'batch' and self.prefilter is None):
+                self.RunColumns( progress )
+            else:
+                results = []
+                for i in arange(len(self.Data)):
+                    if progress is not None:
+                        progress( i, len(self.Data) )
+                    with timings.Stage( 'key', i+1, len(self.Times) ):
+                        key = self.DetectionKey( i )
+                        result = self.Detections.Get( key )
+                    if result is None:
+                        result = self.PeakDetector( self.Data[i], self.delta, self.numnei, i+1 )
+                        self.Detections.Put( key, result )
+                    results.append( self.PartitionSeries( result, i+1 ) )
+                if progress is not None:
+                    progress( len(self.Data), len(self.Data) )
+                self.Results = results
+
+            self.Detections.Save()
+            stage.peaks = sum( len(result) for results in self.Results for result in results )
+
+    def DetectionKey( self, i ):
+        """
+        identifies a whole series detection of series i with the current
+        parameters, by the series' contents rather than which file it came
+        from (except with self.chunk, see HashSeries)
+        """
+        i = int(i)
+        if i not in self.SeriesHashes:
+            self.HashSeries()
+        detector = 'billauer' if self.engine in BILLAUER_ENGINES else self.engine
+        return (RESULT_VERSION, self.SeriesHashes[i], 0, len(self.Times), self.delta, self.numnei, detector, self.prefilter)
+
+    def HashSeries( self ):
+        """
+        hashes every series for DetectionKey, in one pass down the rows -
+        which gives the same hashes as each series on its own. With
+        self.chunk that pass would read the whole file once more than the
+        detection does, so the series are identified by the file they are
+        mapped from (its path, size and mtime, as in cacheKey) instead.
+        """
+        if self.chunk is not None and isinstance(self.Block, np.memmap):
+            source = cacheKey( self.Block.filename, self.Data.dtype ).strip()
+            self.SeriesHashes = dict( (i, '%s:%d' % (source, i+1)) for i in range(len(self.Data)) )
+            return
+
+        step = max(self.chunk or len(self.Times), 1)
+        digests = [ hashlib.sha1() for i in range(len(self.Data)) ]
+        for lo in xrange(0, len(self.Times), step):
+            rows = self.Block[lo:lo+step]
+            for i, digest in enumerate(digests):
+                digest.update( np.ascontiguousarray(rows[:,i+1]) )
+        self.SeriesHashes = dict( (i, '%s:%s' % (self.Data.dtype.str, digest.hexdigest())) for i, digest in enumerate(digests) )
+
+    def RunColumns( self, progress=None ):
+        """
+        same as Run, but the series that aren't cached are detected
+        together: with self.chunk in one pass down the rows, a chunk at a
+        time (see detectRows), so the data is read from disk once and in
+        order and only about a chunk of it is in memory at once. Otherwise
+        (the 'batch' engine) all the series step through each window of
+        rows at once, see detectBatch.
+
+        Neither smooths the data first, so with a prefilter Run detects
+        one series at a time instead.
+        """
+        self.CheckDelta( self.delta )
+
+        with self.Timings.Stage( 'key', 0, self.Data.size ):
+            results = [ self.Detections.Get( self.DetectionKey( i ) ) for i in arange(len(self.Data)) ]
+        missing = [ i for i in range(len(results)) if results[i] is None ]
+
+        if progress is not None:
+            progress( len(results) - len(missing), len(results) )
+        timings = self.Timings if isinstance(self.Timings, Timings) else None
+        columns = [ i+1 for i in missing ]
+        if not columns:
+            found = []
+        elif self.chunk is not None:
+            found = detectRows( self.Block, columns, self.delta, self.numnei, self.chunk, timings )
+        else:
+            found = detectBatch( self.Block, columns, self.delta, self.numnei, self.basemode, timings )
+        for i, result in zip(missing, found):
+            self.Detections.Put( self.DetectionKey( i ), result )
+            results[i] = result
+        if progress is not None:
+            progress( len(results), len(results) )
+
+        self.Results = [ self.PartitionSeries( result, i+1 ) for i, result in enumerate(results) ]
+
+    def RunParallel( self, progress=None ):
+        """
+        same as Run, but with the series sent to a pool of self.workers
+        processes. The workers read the data from shared memory (or the
+        memory mapped cache) rather than having it pickled.
+        """
+        self.CheckDelta( self.delta )
+
+        # only copy into shared memory again when the data has changed
+        if self.Shared is None or self.Shared[0] is not self.Block:
+            self.Shared = (self.Block, sharedBlock( self.Block ))
+
+        with self.Timings.Stage( 'key', 0, self.Data.size ):
+            results = [ self.Detections.Get( self.DetectionKey( i ) ) for i in arange(len(self.Data)) ]
+        missing = [ i for i in range(len(results)) if results[i] is None ]
+        timed = isinstance(self.Timings, Timings)
+        tasks = [ (i+1, 0, len(self.Times), self.delta, self.numnei, self.engine, self.basemode, self.prefilter, self.chunk, timed) for i in missing ]
+
+        done = len(results) - len(missing)
+        if progress is not None:
+            progress( done, len(results) )
+
+        if tasks:
+            pool = multiprocessing.Pool( self.workers, initWorker, (self.Shared[1],) )
+            try:
+                for i, result in zip(missing, pool.imap( detectTask, tasks, chunksize=1 )):
+                    if timed:
+                        result, stages = result
+                        self.Timings.Merge( stages )
+                    self.Detections.Put( self.DetectionKey( i ), result )
+                    results[i] = result
+                    done += 1
+                    if progress is not None:
+                        progress( done, len(results) )
+            except:
+                pool.terminate()
+                raise
+            else:
+                pool.close()
+            finally:
+                pool.join()
+
+        self.Results = [ self.PartitionSeries( result, i+1 ) for i, result in enumerate(results) ]
+
+    def PartitionResult( self, result ):
+        """
+        splits a PeakResult for a whole series into one per segment, by
+        where each peak (and minimum) lies, with the timestamps filled in.
+        Bases go with their peaks.
+        """
+        times = asarray(self.Times, dtype=np.float64)
+        return [ result.Segment( start, stop, times ) for start, stop in zip(self.Breaks[:-1], self.Breaks[1:]) ]
+
+    def PartitionSeries( self, result, series ):
+        with self.Timings.Stage( 'partition', series, len(self.Times) ) as stage:
+            stage.peaks = len(result)
+            return self.PartitionResult( result )
+
+    def Sweep( self, deltas, numneis=None ):
+        """
+        peak statistics for every combination of deltas and numneis (default
+        just self.numnei), for each series and segment, without running a
+        full detection per delta - see sweepExtrema. One SlidingMinimum per
+        numnei finds the bases for all the deltas.
+
+        returns a record array with a row per series, delta, numnei and
+        segment: the number of peaks and their mean Delta and ISP, as in
+        the Average row of Print (NaN where there aren't enough peaks)
+        """
+        deltas = np.atleast_1d( asarray(deltas, dtype=np.float64) )
+        if numneis is None:
+            numneis = [ self.numnei ]
+        numneis = [ int(k) for k in np.atleast_1d(numneis) ]
+        for delta in deltas:
+            self.CheckDelta( delta )
+        if self.engine not in BILLAUER_ENGINES:
+            raise ValueError('Sweep needs one of the %s engines, not %s' % (', '.join(BILLAUER_ENGINES), self.engine))
+
+        starts = asarray(self.Breaks[:-1], dtype=np.int64)
+        stops = asarray(self.Breaks[1:], dtype=np.int64)
+        stops = np.maximum(stops, starts)
+        nseg = len(starts)
+        times = asarray(self.Times, dtype=np.float64)
+
+        rows = []
+        for i in range(len(self.Data)):
+            v = self.Data[i]
+            if self.prefilter is not None:
+                v = PREFILTERS[self.prefilter[0]]( v, *self.prefilter[1:] )
+            found = sweepExtrema( v, deltas )
+            values = asarray(v, dtype=np.float64)
+            for numnei in numneis:
+                window = None
+                if numnei > 0:
+                    window = SlidingMinimum( v, 2*numnei )
+                for delta, peaks in zip(deltas, found):
+                    lo = np.searchsorted(peaks, starts)
+                    hi = np.searchsorted(peaks, stops)
+                    count = hi - lo
+
+                    # sums over the peaks of each segment from running totals
+                    mean_delta = np.empty(nseg)
+                    mean_delta.fill(NaN)
+                    if window is not None and len(peaks):
+                        heights = values[peaks] - window.values[ window.argminAround( peaks, numnei ) ]
+                        total = np.concatenate(([0.0], np.cumsum(heights)))
+                        has = count > 0
+                        mean_delta[has] = (total[hi] - total[lo])[has] / count[has]
+
+                    # the ISPs of a segment add up to last peak time - first
+                    mean_isp = np.empty(nseg)
+                    mean_isp.fill(NaN)
+                    has = count > 1
+                    if has.any():
+                        peak_times = times[peaks]
+                        mean_isp[has] = (peak_times[hi[has] - 1] - peak_times[lo[has]]) / (count[has] - 1)
+
+                    for k in range(nseg):
+                        rows.append( (i+1, k, delta, numnei, count[k], mean_delta[k], mean_isp[k]) )
+
+        return np.array( rows, dtype=[('series', np.int32), ('segment', np.int32), ('delta', np.float64),
+                                      ('numnei', np.int32), ('count', np.int64),
+                                      ('mean_delta', np.float64), ('mean_isp', np.float64)] ).view(np.recarray)
+
+    def PrintSweep( self, sweep ):
+        names = breakNames( len(self.Breaks) )
+        print "%8s\t%8s\t%8s\t%8s\t%8s\t%8s\t%8s" % ('Data set','Segment','Delta','Numnei','Peaks','Delta','ISP')
+        for row in sweep:
+            segment = '%s -> %s' % (names[row['segment']], names[row['segment']+1])
+            print "%8s\t%8s\t%8.6g\t%8s\t%8s\t%8.6g\t%8.6g" % (row['series'], segment, row['delta'], row['numnei'],
+                                                        row['count'], row['mean_delta'], row['mean_isp'])
 
     def Print( self ):
+        """
+        prints every series as a table of its segments' peaks - found over
+        the whole series (see Run), so bases may come from a neighbouring
+        segment
+        """
+        names = breakNames( len(self.Breaks) )
         for i in arange(len(self.Data)):
-            atob = self.Results[i][0]
-            btoc = self.Results[i][1]
+            results = self.Results[i]
 
             print
             print "****************   Data set %2d   ***********************" % (i+1)
             print
             print "%8s\t%8s\t%8s\t%8s\t%8s" % ('','Start','End','Length','Peaks')
-            print "%8s\t%8s\t%8s\t%8s\t%8s" % ('--- A -> B ---',self.a_time,self.b_time,(self.b_time-self.a_time),len(atob['Maxima']))
-            print "%8s\t%8s\t%8s\t%8s\t%8s" % ('--- B -> C ---',self.b_time,self.c_time,(self.c_time-self.b_time),len(btoc['Maxima']))
+            for k in range(len(results)):
+                start, end = self.BreakTimes[k], self.BreakTimes[k+1]
+                label = '--- %s -> %s ---' % (names[k], names[k+1])
+                print "%8s\t%8s\t%8s\t%8s\t%8s" % (label,start,end,(end-start),len(results[k]))
             print
-            print "----------   A -> B   ------------\t\t\t\t\t\t\t----------   B -> C   ------------\n"
+            titles = [ "----------   %s -> %s   ------------" % (names[k], names[k+1]) for k in range(len(results)) ]
+            print "\t\t\t\t\t\t\t".join(titles) + "\n"
 
-            tbl = self.CreateTabulatedData(self.A, atob, self.B, btoc)
-            self.PrintTable( tbl )
+            peaks = sum( len(result) for result in results )
+            with self.Timings.Stage( 'tabulate', i+1, len(self.Times) ) as stage:
+                stage.peaks = peaks
+                tbl = self.CreateTabulatedData( zip(self.Breaks, results) )
+            with self.Timings.Stage( 'print', i+1, len(self.Times) ) as stage:
+                stage.peaks = peaks
+                self.PrintTable( tbl )
 
             #self.PrintPeaks( self.A, atob )
             #self.PrintPeaks( self.B, btoc )
             
             print
 
+    def Summary( self ):
+        """
+        statistics of the peaks of every series and segment, taken straight
+        from the result arrays - nothing of the table is built. Returns a
+        record array of SUMMARY_FIELDS.
+        """
+        times = asarray(self.Times, dtype=np.float64)
+        edges = times[ np.minimum(self.Breaks, len(times) - 1) ]
+
+        rows = []
+        for i, results in enumerate(self.Results):
+            for k, result in enumerate(results):
+                start, end = edges[k], edges[k+1]
+                stats = result.Stats()
+                rate = stats[0] / (end - start) if end > start else NaN
+                rows.append( (i+1, k, start, end, stats[0], rate) + stats[1:] )
+
+        return np.array( rows, dtype=SUMMARY_FIELDS ).view(np.recarray)
+
+    def Peaks( self ):
+        """
+        every peak of every series and segment in one structured array: a
+        series and segment number followed by PEAK_FIELDS, with index and
+        base_index counted from the start of the series
+        """
+        fields = [ ('series', np.int32), ('segment', np.int32) ] + PEAK_FIELDS
+        parts = [ np.zeros(0, dtype=fields) ]
+        for i, results in enumerate(self.Results):
+            for k, result in enumerate(results):
+                part = np.empty( len(result.peaks), dtype=fields )
+                for name, kind in PEAK_FIELDS:
+                    part[name] = result.peaks[name]
+                part['series'] = i+1
+                part['segment'] = k
+                part['index'] += self.Breaks[k]
+                if result.has_bases:
+                    part['base_index'] += self.Breaks[k]
+                parts.append( part )
+        return np.concatenate( parts )
+
+    def Write( self, filename, format=None ):
+        """
+        writes the peaks (see Peaks) and the Summary to filename in one go,
+        as a table each, in one of OUTPUT_FORMATS - by default the one
+        matching the extension of filename
+        """
+        if format is None:
+            format = os.path.splitext(filename)[1].lstrip('.')
+        if format not in OUTPUT_FORMATS:
+            raise ValueError('unknown output format %s, expected one of %s' % (format, ', '.join(sorted(OUTPUT_FORMATS))))
+        with self.Timings.Stage( 'write', 0, self.Data.size ) as stage:
+            peaks = self.Peaks()
+            OUTPUT_FORMATS[format]( filename, OrderedDict( [('peaks', peaks), ('summary', self.Summary())] ) )
+            stage.peaks = len(peaks)
+
+    def PrintSummary( self, summary ):
+        names = breakNames( len(self.Breaks) )
+        print "%8s\t%8s\t%8s\t%8s\t%8s\t%8s\t%8s\t%8s\t%8s\t%8s" % ('Data set','Segment','Peaks','Rate',
+                                                                    'Delta','(median)','(std)','ISP','(median)','(std)')
+        for row in summary:
+            segment = '%s -> %s' % (names[row['segment']], names[row['segment']+1])
+            print "%8s\t%8s\t%8s\t%8.6g\t%8.6g\t%8.6g\t%8.6g\t%8.6g\t%8.6g\t%8.6g" % (row['series'], segment, row['count'], row['rate'],
+                                                                            row['mean_delta'], row['median_delta'], row['std_delta'],
+                                                                            row['mean_isp'], row['median_isp'], row['std_isp'])
+
     def PrintTable(self, tbl ):
         for row in tbl:
             for item in row:
                 print '%s\t' % item,
             print
 
-    def CreateTabulatedData(self,aoff, atob, boff, btoc):
-        ''' turn atob and btoc results into a list of lists for printing
+    def CreateTabulatedData(self, segments):
+        ''' turn a list of (offset, result) segments into a list of lists for
+            printing, a group of columns per segment
             [ ['Peak 1', '10', '20', '30', 'Peak 1', '10', '20' ,'30']
               ['', '', '', '',             'Peak 2', '10', '20' ,'30']
               ['', '', '', '',             'Average', '' , ''   ,'30'] ]
 
         '''
+        columns = []
+        for off, result in segments:
+            peaks = result.peaks
 
-        atob_peaks = atob['Maxima']
-        atob_bases = atob['Bases']
-
-        btoc_peaks = btoc['Maxima']
-        btoc_bases = btoc['Bases']
-
-        atob_peak_times = [self.Times[j] for j in [ atob_peaks[i][0] + aoff for i in arange(len(atob_peaks)) ]]
-        atob_base_times = [self.Times[j] for j in [ atob_bases[i][0] + aoff for i in arange(len(atob_bases)) ]]
-        atob_deltas     = [atob_peaks[i][1] - atob_bases[i][1] for i in arange(len(atob_peaks))]
-    
-        atob_isp_times = []
-        for i in range(1,len(atob_peaks)):
-            atob_isp_times.append( atob_peak_times[i] - atob_peak_times[i-1] )
+            # times and ISPs print as python floats, the rest as numpy's
+            peak_times = peaks['time'].tolist()
+            values     = list( peaks['value'] )
+            bases      = list( peaks['base_value'] )
+            deltas     = list( peaks['delta'] )
+            isp_times  = peaks['isp'][1:].tolist()
 
+            count, avg_delta, med_delta, std_delta, avg_isp, med_isp, std_isp = result.Stats()
 
-        btoc_peak_times = [self.Times[j] for j in [ btoc_peaks[i][0] + boff for i in arange(len(btoc_peaks)) ]]
-        btoc_base_times = [self.Times[j] for j in [ btoc_bases[i][0] + boff for i in arange(len(btoc_bases)) ]]
-        btoc_deltas     = [btoc_peaks[i][1] - btoc_bases[i][1] for i in arange(len(btoc_peaks))]
-    
-        btoc_isp_times = []
-        for i in range(1,len(btoc_peaks)):
-            btoc_isp_times.append( btoc_peak_times[i] - btoc_peak_times[i-1] )
+            columns.append( (peak_times, values, bases, deltas, isp_times, avg_delta, float(avg_isp)) )
 
         results = []
 
-        # column headings
-        results.append( ['Peak#','Time','Base','Peak','Delta','ISP','','Peak#','Time','Base','Peak','Delta','ISP'] )
+        # column headings, with a spacer between segments
+        heading = []
+        for k in range(len(columns)):
+            if k > 0:
+                heading.append( '' )
+            map( heading.append, ['Peak#','Time','Base','Peak','Delta','ISP'] )
+        results.append( heading )
 
-        num_rows = max( len(atob_peaks), len(btoc_peaks) )
+        num_rows = max( [ len(c[0]) for c in columns ] )
         for i in range(num_rows+1):
             row = []
-            if i < len(atob_peaks): # add atob peak
-                peak = atob_peaks[i]
-                peak_time = atob_peak_times[i]
-                base = atob_bases[i]
-                base_time = atob_base_times[i]
-
-                map( row.append, [i+1, peak_time, base[1], peak[1], atob_deltas[i]] )
-
-                if( i > 0):
-                    isp = atob_isp_times[i-1]
-                    row.append( isp )
+            for k, (peak_times, values, bases, deltas, isp_times, avg_delta, avg_isp) in enumerate(columns):
+                if k > 0:
                     row.append( '' )
-                else:
-                    row.append( '' )
-                    row.append( '' )
-            else:
-                if i == len(atob_peaks) and i > 1:
-                    avg_delta = (sum(atob_deltas)/len(atob_deltas))
-                    avg_isp   = (sum(atob_isp_times)/len(atob_isp_times));
-                    map( row.append, ['Average','','','',avg_delta,avg_isp,''] )
-                else:
-                    map( row.append, ['','','','','','',''])
-
-            if i < len(btoc_peaks): # add btoc peak
-                peak = btoc_peaks[i]
-                peak_time = btoc_peak_times[i]
-                base = btoc_bases[i]
-                base_time = btoc_base_times[i]
 
-                map( row.append, [i+1, peak_time, base[1], peak[1], btoc_deltas[i] ] )
+                if i < len(values): # add peak
+                    map( row.append, [i+1, peak_times[i], bases[i], values[i], deltas[i]] )
 
-                if( i > 0):
-                    isp = btoc_isp_times[i-1]
-                    row.append( isp )
-                else:
-                    row.append( '' )
-            else:
-                if i == len(btoc_peaks) and i > 1:
-                    avg_delta = (sum(btoc_deltas)/len(btoc_deltas))
-                    avg_isp   = (sum(btoc_isp_times)/len(btoc_isp_times));
-                    map( row.append, ['Average','','','',avg_delta,avg_isp] )
+                    if( i > 0):
+                        row.append( isp_times[i-1] )
+                    else:
+                        row.append( '' )
                 else:
-                    map( row.append, ['','','','','',''])
+                    if i == len(values) and i > 1:
+                        map( row.append, ['Average','','','',avg_delta,avg_isp] )
+                    else:
+                        map( row.append, ['','','','','',''])
 
             results.append(row)
         return results
 
-    def PeakDetector( self, v, delta, numnei=-1):
+    def PeakDetector( self, v, delta, numnei=-1, series=0 ):
         """
         Converted from MATLAB script at http://billauer.co.il/peakdet.html
         
-        Currently returns two lists of tuples, but maybe arrays would be better
+        Returns a PeakResult, its arrays of peaks and minima indexed from
+        the start of v and timed in samples (see PeakFinder.PartitionResult)
         
         function [maxtab, mintab]=PeakDetector(v, delta, numnei)
         %PeakDetector   Detect peaks in a vector
@@ -202,82 +2352,39 @@ class PeakFinder:
         %               point within +- NUMNEI indices of the peak index.
         
         % Based on code by Eli Billauer
+
+        self.engine picks the detector from ENGINES (those in
+        BILLAUER_ENGINES give the results described above), self.prefilter
+        any smoothing first and self.basemode how findBases looks for the
+        bases. series is only what the stages are recorded under in
+        self.Timings.
+
+        With self.chunk set, v is read that many samples at a time
+        instead (see detectChunked).
         """
-        maxtab = []
-        mintab = []
-        bases = []
-           
-        x = arange(len(v))
-        
         v = asarray(v)
-        
-        if len(v) != len(x):
-            sys.exit('Input vectors v and x must have same length')
-        
+
+        self.CheckDelta( delta )
+
+        timings = self.Timings if isinstance(self.Timings, Timings) else None
+        if self.chunk is not None:
+            return detectChunked( v, delta, numnei, self.chunk, timings, series )
+        return detect( v, delta, numnei, self.engine, self.basemode, self.prefilter, timings, series )
+
+    def CheckDelta( self, delta ):
         if not isscalar(delta):
-            sys.exit('Input argument delta must be a scalar')
-        
+            raise ValueError('Input argument delta must be a scalar')
+
         if delta <= 0:
-            sys.exit('Input argument delta must be positive')
-        
-        mn, mx = Inf, -Inf
-        mnpos, mxpos = NaN, NaN
-        
-        base = 0 
-        basepos = NaN
-        
-        lookformax = True
-        
-        for i in arange(len(v)):
-            this = v[i]
-            if this > mx:
-                mx = this
-                mxpos = x[i]
-            if this < mn:
-                mn = this
-                mnpos = x[i]
-    
-            if lookformax:
-                if this < mx-delta:
-                    maxtab.append((mxpos, mx))
-                    mn = this
-                    mnpos = x[i]
-    
-                    if numnei > 0:
-                        base,basepos = self.getLowestInNeighbourhood( v, mxpos, numnei )
-                        bases.append((basepos,base))
-    
-                    lookformax = False
-    
-            else:
-                if this > mn+delta:
-                    mintab.append((mnpos, mn))
-                    mx = this
-                    mxpos = x[i]
-                    lookformax = True
-    
-        return {'Maxima':maxtab,'Minima':mintab, 'Bases':bases}
-    
+            raise ValueError('Input argument delta must be positive')
+
     def getLowestInNeighbourhood( self, data, index, numnei ):
         """
         finds the lowest value in vector data in the range
         (data[index - numnei], data[index + numnei])
         """
-    
-        minIdx = max(index - numnei, 0)
-        maxIdx = min(index + numnei, len(data))
-    
-        lowest = +Inf
-        lowest_idx = minIdx
-    
-        for i in range(minIdx,maxIdx):
-            if data[i] < lowest:
-                lowest = data[i]
-                lowest_idx = i
-    
-        #print minIdx, maxIdx, lowest, lowest_idx
-        return lowest,lowest_idx
-    
+        return getLowestInNeighbourhood( data, index, numnei )
+
     def CheckOutput( self, peaks, bases ):
         if len(peaks) == 0:
             print 'Warning: No peaks found'
@@ -290,71 +2397,247 @@ class PeakFinder:
         return True
     
     def Plot( self, fig ):
+        """
+        draws every series on fig, one axes each, as a DecimatedLine with
+        the segment boundaries and the peaks and bases of each segment
+        """
         fig.clear()
+        self.Lines = []
+        self.Marks = []
+        self.Plotted = (fig, self.Block)
         for i in arange(len(self.Data)):
             data = self.Data[i]
-            atob = self.Results[i][0]
-            btoc = self.Results[i][1]
-            #times = [self.Times[j] for j in [ xima'][i][0] for i in arange(len(atob['Maxima'])) ]]
             times = self.Times
             ax = fig.add_subplot(len(self.Data),1,i+1)
             ax.clear()
 
-            ax.plot(times, data, color='k')
-            ax.grid(True)
-
-            if( self.A < len(self.Times) ):
-                ax.axvline( x=self.Times[self.A],ymin=0, ymax=2,color='k')
-            if( self.B < len(self.Times) ):
-                ax.axvline( x=self.Times[self.B],ymin=0, ymax=2,color='r')
-            if( self.C < len(self.Times) ):
-                ax.axvline( x=self.Times[self.C],ymin=0, ymax=2,color='k')
-     
-            self.PlotPeaks( ax, '', self.A, atob, times )
-            self.PlotPeaks( ax, '', self.B, btoc, times )
-    
-    def PlotPeaks( self, ax, label, offset, result, times ):
-        peaks = result['Maxima']
-        bases = result['Bases']
-        for i in arange(len(peaks)):
-            peak = list(peaks[i])
-            peak[0] = peak[0] + offset
-            base = list(bases[i])
-            base[0] = base[0] + offset
-            self.annotate( ax, times, '', peak, +0.1)
-            self.annotate( ax, times, '', base, -0.1, 'blue' )
-    
-    def annotate( self, ax, times,  caption, point, offset=0.1, color='red' ):
-        ax.annotate(caption, xy=(times[point[0]], point[1]),  xycoords='data',
-                    xytext=(times[point[0]], point[1] + offset), textcoords='data',
-                    arrowprops=dict(facecolor=color, shrink=0.05),
-                    horizontalalignment='center', verticalalignment='top',
-                    )
+            with self.Timings.Stage( 'plot', i+1, len(data) ) as stage:
+                self.Lines.append( DecimatedLine( ax, times, data, color='k' ) )
+                ax.grid(True)
+
+                self.Marks.append( self.PlotMarks( ax, i ) )
+                stage.peaks = sum( len(result) for result in self.Results[i] )
+
+    def UpdatePlot( self, fig ):
+        """
+        brings fig up to date after a Reset by redrawing only the segment
+        boundaries and peak markers of the axes whose results changed,
+        leaving the data lines alone. Falls back to a full Plot if fig
+        wasn't drawn by Plot from the current data.
+
+        returns whether anything was redrawn
+        """
+        if self.Plotted is None or self.Plotted[0] is not fig or self.Plotted[1] is not self.Block:
+            self.Plot( fig )
+            return True
+
+        changed = False
+        for i, (ax, key, artists) in enumerate(self.Marks):
+            if key == self.MarksKey( i ):
+                continue
+            with self.Timings.Stage( 'plot', i+1 ) as stage:
+                for artist in artists:
+                    artist.remove()
+                self.Marks[i] = self.PlotMarks( ax, i )
+                stage.peaks = sum( len(result) for result in self.Results[i] )
+            changed = True
+        return changed
+
+    def MarksKey( self, i ):
+        """
+        identifies what PlotMarks draws for series i
+        """
+        return (tuple(self.Breaks), ''.join( result.peaks.tobytes() for result in self.Results[i] ))
+
+    def PlotMarks( self, ax, i ):
+        """
+        draws the segment boundaries and peaks of series i on ax
+
+        returns ax, MarksKey(i) and the artists drawn
+        """
+        artists = []
+
+        # outer boundaries black, the ones between segments red
+        last = len(self.Breaks) - 1
+        for k, idx in enumerate(self.Breaks):
+            if( idx < len(self.Times) ):
+                color = 'k' if k in (0, last) else 'r'
+                artists.append( ax.axvline( x=self.Times[idx],ymin=0, ymax=2,color=color) )
+
+        artists.extend( self.PlotPeaks( ax, '', zip(self.Breaks, self.Results[i]), self.Times ) )
+        return ax, self.MarksKey( i ), artists
+
+    def PlotPeaks( self, ax, label, segments, times ):
+        """
+        marks the peaks (red) and bases (blue) of a list of (offset,
+        result) segments, each as a single scatter
+
+        returns the scatters
+        """
+        peaks = np.concatenate( [ result.peaks['index'] + offset for offset, result in segments ] )
+        values = np.concatenate( [ result.peaks['value'] for offset, result in segments ] )
+        artists = [ ax.scatter( times[peaks], values, marker='v', color='red', zorder=3 ) ]
+
+        based = [ (offset, result) for offset, result in segments if result.has_bases ]
+        if based:
+            bases = np.concatenate( [ result.peaks['base_index'] + offset for offset, result in based ] )
+            values = np.concatenate( [ result.peaks['base_value'] for offset, result in based ] )
+            artists.append( ax.scatter( times[bases], values, marker='^', color='blue', zorder=3 ) )
+        return artists
 
     def ParseDataFromCSV( self, filename ):
         """
         expects filename to be a CSV file in which the first column
         is timestamps, and the remaining columns are data series
+        (or a .npy file of the same layout)
+
+        returns the float64 timestamps and a (series x samples) array, a
+        view into the single array from loadTraces (kept as self.Block)
+        - memory mapped unless caching is off. The block is column-major,
+        so each series is contiguous and Run never copies one. With
+        self.chunk it has to be memory mapped, or ValueError is raised.
         """
-    
-        csv_file = csv.reader(open(filename, "rb" ))
-        csv_data = []
-        csv_data.extend(csv_file)
-    
-        times = []
-    
-        # fill data_series array with an array per column of data
-        data = [ [] for i in range(len(csv_data[0])-1)]
-    
-        # now fill each array in data_series with the CSV data
-        for row in csv_data:
-            times.append(float(row[0]))
-            for i in arange(len(row[1:])):
-                data[i].append(float(row[i+1]))
-    
-        return times, data
+        with self.Timings.Stage( 'parse' ) as stage:
+            times, self.Block = loadTraces( filename, self.dtype, self.cache, self.chunk is None )
+            stage.samples = self.Block.size
+        return times, self.Block[:,1:].T
     
     
+# files picked up from a directory given to --batch
+BATCH_EXTENSIONS = ('.csv', '.npy')
+
+def findFiles( patterns ):
+    """
+    expands a list of globs, directories (every BATCH_EXTENSIONS file in
+    them) and plain filenames into a list of files, each once, in the
+    order given
+    """
+    files = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            found = sorted( os.path.join(pattern, name) for name in os.listdir(pattern)
+                            if os.path.splitext(name)[1].lower() in BATCH_EXTENSIONS )
+        else:
+            found = sorted(glob.glob(pattern)) or [ pattern ]
+        for name in found:
+            if name not in files:
+                files.append( name )
+    return files
+
+def readManifest( filename ):
+    """
+    the files (or globs, or directories) listed in filename, one per line,
+    skipping blank lines and # comments
+    """
+    f = open(filename)
+    try:
+        lines = [ line.strip() for line in f ]
+    finally:
+        f.close()
+    return [ line for line in lines if line and not line.startswith('#') ]
+
+def batchTask( task ):
+    """
+    runs PeakFinder over one file of a batch, in a pool worker. Never
+    raises: a failure comes back as the error message.
+
+    returns filename, seconds, error (or None), peaks, summary
+    """
+    filename, delta, numnei, a, b, c, options = task
+    start = time.time()
+    try:
+        finder = PeakFinder( filename, delta, numnei, a, b, c, **options )
+        finder.Run()
+        return filename, time.time() - start, None, finder.Peaks(), finder.Summary()
+    except Exception, err:
+        return filename, time.time() - start, '%s: %s' % (type(err).__name__, err), None, None
+
+def runBatch( files, delta, numnei, a, b, c, options, workers=1, report=None ):
+    """
+    runs batchTask for every file, across a pool of workers processes,
+    calling report with each result as it arrives (in file order).
+
+    Each file is detected with a single process and no result cache file,
+    which the workers would otherwise all write to. Unless options has
+    cache=False, a CSV file gets its .npy cache written next to it (see
+    loadTraces) - main turns that off for --batch unless --cache is given.
+
+    returns the batchTask results
+    """
+    options = dict( options, workers=1, result_cache=None )
+    tasks = [ (filename, delta, numnei, a, b, c, options) for filename in files ]
+
+    pool = None
+    if workers > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool( min(workers, len(tasks)) )
+        results = pool.imap( batchTask, tasks, chunksize=1 )
+    else:
+        results = ( batchTask( task ) for task in tasks )
+
+    done = []
+    try:
+        for result in results:
+            if report is not None:
+                report( result )
+            done.append( result )
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return done
+
+def withColumn( table, name, dtype, value ):
+    """
+    a copy of the structured array table with a column name in front
+    """
+    out = np.empty( len(table), dtype=[ (name, dtype) ] + table.dtype.descr )
+    for field in table.dtype.names:
+        out[field] = table[field]
+    out[name] = value
+    return out
+
+def combineBatch( results ):
+    """
+    the peaks and summaries of every file of a batch as single tables,
+    numbered by a file column, plus a files table of the name, time taken,
+    number of peaks and error (empty if none) for each file
+    """
+    names = [ r[0] for r in results ]
+    errors = [ r[2] or '' for r in results ]
+    files = np.zeros( len(results), dtype=[ ('file', np.int32),
+                                            ('name', 'S%d' % max([1] + map(len, names))),
+                                            ('seconds', np.float64), ('peaks', np.int64),
+                                            ('error', 'S%d' % max([1] + map(len, errors))) ] )
+    files['file'] = arange(len(results))
+    files['name'] = names
+    files['seconds'] = [ r[1] for r in results ]
+    files['error'] = errors
+
+    peaks = []
+    summaries = []
+    for k, (filename, seconds, error, filepeaks, summary) in enumerate(results):
+        if error is None:
+            files['peaks'][k] = len(filepeaks)
+            peaks.append( withColumn( filepeaks, 'file', np.int32, k ) )
+            summaries.append( withColumn( summary, 'file', np.int32, k ) )
+
+    if not peaks:
+        fields = [ ('series', np.int32), ('segment', np.int32) ] + PEAK_FIELDS
+        peaks = [ withColumn( np.zeros(0, dtype=fields), 'file', np.int32, 0 ) ]
+        summaries = [ withColumn( np.zeros(0, dtype=SUMMARY_FIELDS), 'file', np.int32, 0 ) ]
+
+    return OrderedDict( [ ('peaks', np.concatenate(peaks)),
+                          ('summary', np.concatenate(summaries)),
+                          ('files', files) ] )
+
+def reportBatch( result ):
+    filename, seconds, error, peaks, summary = result
+    if error is None:
+        print "%8.3fs\t%8d peaks\t%s" % (seconds, len(peaks), filename)
+    else:
+        print "%8.3fs\t%14s\t%s\t%s" % (seconds, 'FAILED', filename, error)
+    sys.stdout.flush()
+
 def ParseArgs( argv ):
     filename = "data.csv"
     delta    = 0.2 # jump in value to determine maxima/minima
@@ -364,16 +2647,22 @@ def ParseArgs( argv ):
     c = 1500
     
     try:
-        opts, args = getopt.getopt(argv[1:], "f:d:n:pa:b:c:", ["file=", "delta=", "numnei=", "plot"])
+        opts, args = getopt.getopt(argv[1:], "f:d:n:pa:b:c:e:j:s:", ["file=", "delta=", "numnei=", "plot", "engine=", "bases=", "float32", "cache", "no-cache", "exact-indices", "jobs=", "segments=", "cache-size=", "result-cache=", "sweep=", "summary", "output=", "format=", "batch=", "manifest=", "prefilter=", "timings", "profile=", "chunk="])
     except getopt.GetoptError, err:
         print str(err)
         #usage()
-        print 'usage: ', argv[0], ' --file data.csv --delta 0.2 --numnei 10 -a 50 -b 500 -c 1500'
+        print 'usage: ', argv[0], ' --file data.csv --delta 0.2 --numnei 10 -a 50 -b 500 -c 1500 [--engine billauer|numpy|loop|batch|prominence|derivative] [--prefilter mean:5|savgol:11:3] [--bases auto|scan|window] [--float32] [--cache|--no-cache] [--exact-indices] [--jobs 4] [--segments 50,500,1500,2000] [--cache-size 1024] [--result-cache results.pkl] [--sweep 0.05:1.0:200|0.1,0.2,0.4] [--summary] [--output peaks.npz|peaks.jsonl] [--format npz|jsonl] [--batch "data/*.csv"|data/] [--manifest files.txt] [--timings] [--profile run.prof] [--chunk 1000000]'
         sys.exit(2)
     
     output = None
     verbose = False
     plotfig = False
+    # extra settings, passed through to PeakFinder as keyword arguments
+    # cache None is on for a single file and off for --batch, see main
+    options = { 'engine': 'numpy', 'basemode': 'auto', 'dtype': np.float64, 'cache': None,
+                'compat_indices': True, 'workers': 1, 'segments': None,
+                'cache_size': 1024, 'result_cache': None, 'prefilter': None,
+                'timings': False, 'profile': None, 'chunk': None }
     for o, arg in opts:
         if o in ("-f", "--file"):
             filename = arg
@@ -389,26 +2678,142 @@ def ParseArgs( argv ):
             b = arg
         elif o in ("-c"):
             c = arg
+        elif o in ("-e", "--engine"):
+            options['engine'] = arg
+        elif o in ("--bases",):
+            options['basemode'] = arg
+        elif o in ("--prefilter",):
+            options['prefilter'] = arg
+        elif o in ("--float32",):
+            options['dtype'] = np.float32
+        elif o in ("--cache",):
+            options['cache'] = True
+        elif o in ("--no-cache",):
+            options['cache'] = False
+        elif o in ("--exact-indices",):
+            options['compat_indices'] = False
+        elif o in ("-j", "--jobs"):
+            options['workers'] = int(arg)
+        elif o in ("-s", "--segments"):
+            # overrides -a -b -c
+            options['segments'] = [ float(t) for t in arg.split(',') ]
+        elif o in ("--cache-size",):
+            options['cache_size'] = int(arg)
+        elif o in ("--result-cache",):
+            options['result_cache'] = arg
+        elif o in ("--sweep",):
+            # start:stop:count, or a list of deltas
+            if ':' in arg:
+                start, stop, count = arg.split(':')
+                options['sweep'] = np.linspace( float(start), float(stop), int(count) )
+            else:
+                options['sweep'] = [ float(d) for d in arg.split(',') ]
+        elif o in ("--summary",):
+            # statistics only, no table of peaks
+            options['summary'] = True
+        elif o in ("--output",):
+            # written instead of printing the table
+            options['output'] = arg
+        elif o in ("--format",):
+            options['format'] = arg
+        elif o in ("--batch",):
+            # globs or directories, may be given more than once
+            options.setdefault( 'batch', [] ).append( arg )
+        elif o in ("--manifest",):
+            options.setdefault( 'batch', [] ).extend( readManifest( arg ) )
+        elif o in ("--timings",):
+            # the cost of each stage, printed at the end
+            options['timings'] = True
+        elif o in ("--profile",):
+            # cProfile stats of Run, for pstats
+            options['profile'] = arg
+        elif o in ("--chunk",):
+            # rows of each series detected at a time, for files bigger
+            # than memory
+            options['chunk'] = int(float(arg))
         else:
             assert False, "unhandled option"
     
-    return filename, float(delta), int(numnei), plotfig, a, b, c
+    return filename, float(delta), int(numnei), plotfig, a, b, c, options
     
    
     
 
 def main():
-    filename, delta, numnei, plotfig, a, b, c = ParseArgs( sys.argv )
+    filename, delta, numnei, plotfig, a, b, c, options = ParseArgs( sys.argv )
+    sweep = options.pop( 'sweep', None )
+    summary = options.pop( 'summary', False )
+    output = options.pop( 'output', None )
+    format = options.pop( 'format', None )
+    batch = options.pop( 'batch', None )
+
+    if batch is not None:
+        # per file instrumentation has nowhere to go from the workers
+        options.pop( 'timings' )
+        options.pop( 'profile' )
+        # a single pass over each file gains nothing from a .npy copy of
+        # it, so those are only written with --cache - or with --chunk,
+        # which needs the file memory mapped
+        if options['cache'] is None:
+            options['cache'] = options['chunk'] is not None
+        return mainBatch( findFiles( batch ), delta, numnei, a, b, c, options, output, format )
+
+    if options['cache'] is None:
+        options['cache'] = True
+
+    try:
+        myPeakFinder = PeakFinder( filename, delta, numnei, a, b, c, **options )
 
-    myPeakFinder = PeakFinder( filename, delta, numnei, a, b, c )
+        if sweep is not None:
+            myPeakFinder.PrintSweep( myPeakFinder.Sweep( sweep ) )
+            return
 
-    myPeakFinder.Run()
-    myPeakFinder.Print()
+        myPeakFinder.Run()
+    except ValueError, err:
+        sys.exit( str(err) )
+
+    if output is not None:
+        myPeakFinder.Write( output, format )
+    if summary:
+        myPeakFinder.PrintSummary( myPeakFinder.Summary() )
+    if output is None and not summary:
+        myPeakFinder.Print()
 
     if plotfig:
-        fig = plt.figure()
+        fig = pyplot().figure()
         myPeakFinder.Plot(fig)
-        plt.show()
+
+    if options['timings']:
+        print
+        myPeakFinder.Timings.Print()
+    if options['timings'] or options['result_cache'] is not None:
+        print
+        print myPeakFinder.Detections.Stats()
+
+    if plotfig:
+        pyplot().show()
+
+def mainBatch( files, delta, numnei, a, b, c, options, output, format ):
+    """
+    --batch: every file through runBatch, reporting each as it finishes,
+    then the combined tables written to output (if given). Exits with 1
+    if any file failed.
+    """
+    if format is None and output is not None:
+        format = os.path.splitext(output)[1].lstrip('.')
+    if output is not None and format not in OUTPUT_FORMATS:
+        sys.exit('unknown output format %s, expected one of %s' % (format, ', '.join(sorted(OUTPUT_FORMATS))))
+
+    start = time.time()
+    workers = options['workers'] or multiprocessing.cpu_count()
+    results = runBatch( files, delta, numnei, a, b, c, options, workers, reportBatch )
+    failed = len([ r for r in results if r[2] is not None ])
+    print "%d files, %d failed, %.3fs" % (len(results), failed, time.time() - start)
+
+    if output is not None:
+        OUTPUT_FORMATS[format]( output, combineBatch( results ) )
+    if failed:
+        sys.exit(1)
 
 if __name__=="__main__":
     main()
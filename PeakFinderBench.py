@@ -0,0 +1,416 @@
+#!/usr/bin/env python
+"""
+timings for the slow parts of PeakFinder (and of starting it), e.g.
+
+    python PeakFinderBench.py --file data.csv
+    python PeakFinderBench.py --rows 1000000 --series 3
+
+or, with --suite, every stage over synthetic traces of growing length,
+with the results kept for comparing later runs against
+
+    python PeakFinderBench.py --suite --sizes 1000,1000000 --results bench.jsonl
+    python PeakFinderBench.py --suite --sizes 1000,1000000 --compare bench.jsonl
+
+The suite's peak memory figures are only exact on linux, see
+PeakFinder.Timings.
+"""
+
+import getopt,sys,os,time,tempfile
+import csv
+import json
+import shutil
+import subprocess
+import multiprocessing
+from cStringIO import StringIO
+
+import numpy as np
+
+import PeakFinder
+
+def legacyParseCSV( filename ):
+    """
+    the original PeakFinder.ParseDataFromCSV, kept as the baseline for
+    loadCSV
+    """
+    csv_file = csv.reader(open(filename, "rb" ))
+    csv_data = []
+    csv_data.extend(csv_file)
+
+    times = []
+    data = [ [] for i in range(len(csv_data[0])-1)]
+    for row in csv_data:
+        times.append(float(row[0]))
+        for i in range(len(row[1:])):
+            data[i].append(float(row[i+1]))
+
+    return times, data
+
+def writeSyntheticCSV( filename, rows, series, seed=0 ):
+    """
+    writes rows lines of a time column plus series noisy sine waves
+    """
+    rng = np.random.RandomState(seed)
+    f = open(filename, 'wb')
+    chunk = 100000
+    for start in range(0, rows, chunk):
+        t = np.arange(start, min(rows, start + chunk)) * 0.01
+        cols = [t] + [ np.sin(t * (i+1)) + 0.05 * rng.randn(len(t)) for i in range(series) ]
+        np.savetxt(f, np.column_stack(cols), fmt='%.6f', delimiter=',')
+    f.close()
+
+# width (in samples) of the pulses in syntheticTraces
+PULSE_WIDTH = 5
+
+def syntheticTraces( rows, series, density=5.0, noise=0.05, seed=0 ):
+    """
+    a (rows x 1+series) block laid out like a parsed CSV: a time column
+    and series traces of gaussian pulses - density per 1000 samples on
+    average, at random places and heights - on a slow drift, plus gaussian
+    noise of sd noise
+    """
+    rng = np.random.RandomState(seed)
+    block = np.empty((rows, series + 1))
+    block[:,0] = np.arange(rows) * 0.01
+
+    x = np.arange(-4*PULSE_WIDTH, 4*PULSE_WIDTH + 1)
+    pulse = np.exp(-0.5 * (x / float(PULSE_WIDTH))**2)
+    for j in range(series):
+        count = rng.poisson(density * rows / 1000.0)
+        impulses = np.bincount( rng.randint(0, rows, count), rng.uniform(0.5, 1.5, count), minlength=rows )
+        trace = np.convolve( impulses, pulse, 'same' )
+        trace += 0.2 * np.sin(block[:,0] / (50.0 + 10*j)) + noise * rng.randn(rows)
+        block[:,j+1] = trace
+    return block
+
+def best( fn, repeat, *args ):
+    """
+    best wall time of repeat calls to fn(*args)
+    """
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        fn(*args)
+        times.append(time.time() - start)
+    return min(times)
+
+def BenchParse( filename, repeat ):
+    print "parsing %s (%d bytes)" % (filename, os.path.getsize(filename))
+    print "%-24s\t%10s" % ('', 'seconds')
+    for name, fn, args in [ ('csv.reader (legacy)', legacyParseCSV, ()),
+                            ('loadCSV float64', PeakFinder.loadCSV, ()),
+                            ('loadCSV float32', PeakFinder.loadCSV, (np.float32,)) ]:
+        print "%-24s\t%10.4f" % (name, best(fn, repeat, filename, *args))
+
+# the loop engine is timed on this many samples at most, it would take
+# minutes over the full series
+LOOP_SAMPLES = 100000
+
+def BenchDetectors( rows, repeat, delta=0.5, numnei=10 ):
+    """
+    throughput of every engine in PeakFinder.ENGINES, alone and after each
+    prefilter, on synthetic series of rows samples: slow sines with sparse
+    peaks, and a random walk with a peak every few samples
+    """
+    rng = np.random.RandomState(0)
+    t = np.arange(rows) * 0.01
+    signals = [ ('sparse', np.sin(t) + 0.3 * np.sin(7.3 * t) + 0.05 * rng.randn(rows)),
+                ('dense', np.cumsum(rng.randn(rows))) ]
+
+    for signal, v in signals:
+        print "%s detectors on %d samples, delta %g, numnei %d" % (signal, rows, delta, numnei)
+        print "%-24s\t%10s\t%10s\t%10s" % ('', 'seconds', 'Msamples/s', 'peaks')
+        for prefilter in [ None, ('mean', 9), ('savgol', 21, 3) ]:
+            for engine in sorted(PeakFinder.ENGINES):
+                data = v[:LOOP_SAMPLES] if engine == 'loop' else v
+                seconds = best( PeakFinder.detect, repeat, data, delta, numnei, engine, 'auto', prefilter )
+                peaks = len( PeakFinder.detect( data, delta, numnei, engine, 'auto', prefilter ) )
+                name = engine if prefilter is None else '%s+%s' % (':'.join(map(str, prefilter)), engine)
+                print "%-24s\t%10.4f\t%10.2f\t%10d" % (name, seconds, len(data) / seconds / 1e6, peaks)
+        print
+
+def startup( code ):
+    """
+    runs code in a fresh interpreter, from the directory PeakFinder is in
+    """
+    here = os.path.dirname(os.path.abspath(PeakFinder.__file__))
+    return subprocess.check_output( [sys.executable, '-c', code], cwd=here )
+
+def BenchStartup( repeat ):
+    print "interpreter startup"
+    print "%-24s\t%10s" % ('', 'seconds')
+    for name, code in [ ('python', 'pass'),
+                        ('import numpy', 'import numpy'),
+                        ('import PeakFinder', 'import PeakFinder'),
+                        ('import pyplot', 'import matplotlib.pyplot') ]:
+        print "%-24s\t%10.4f" % (name, best(startup, repeat, code))
+
+    # the analysis path must not drag in matplotlib
+    loaded = startup( 'import sys, PeakFinder; print sorted(m for m in sys.modules if m.split(".")[0] == "matplotlib")' )
+    if loaded.strip() != '[]':
+        print 'Warning: importing PeakFinder loads', loaded.strip()
+    print
+
+# the stages of the suite: each takes the synthetic block, a scratch
+# directory and the settings, and sets up a function to time that
+# returns the number of peaks it found (or None)
+
+def stageParse( block, workdir, settings ):
+    filename = os.path.join(workdir, 'traces.csv')
+    np.savetxt(filename, block, fmt='%.6f', delimiter=',')
+    def parse():
+        PeakFinder.loadCSV( filename )
+    return parse
+
+def stageDetect( block, workdir, settings ):
+    def detect():
+        return sum( len( PeakFinder.detect( block[:,j], settings['delta'], -1, settings['engine'], 'auto' ) )
+                    for j in range(1, block.shape[1]) )
+    return detect
+
+def stageBases( mode ):
+    def stage( block, workdir, settings ):
+        peaks = [ PeakFinder.localMaxima( block[:,j] ) for j in range(1, block.shape[1]) ]
+        def bases():
+            for j, positions in enumerate(peaks):
+                PeakFinder.findBases( block[:,j+1], positions, settings['numnei'], mode )
+            return sum(map(len, peaks))
+        return bases
+    return stage
+
+def finderFor( block, workdir, settings ):
+    filename = os.path.join(workdir, 'traces.npy')
+    np.save(filename, block)
+    last = block[-1,0]
+    return PeakFinder.PeakFinder( filename, settings['delta'], settings['numnei'], 0, 0, 0,
+                                  engine=settings['engine'], cache=False, segments=[0, last/3, 2*last/3, 0] )
+
+def stageRun( block, workdir, settings ):
+    finder = finderFor( block, workdir, settings )
+    def run():
+        # nothing cached, so every series is detected again
+        finder.Detections = PeakFinder.ResultCache()
+        finder.Run()
+        return len(finder.Peaks())
+    return run
+
+def stageTabulate( block, workdir, settings ):
+    finder = finderFor( block, workdir, settings )
+    finder.Run()
+    def tabulate():
+        for results in finder.Results:
+            finder.CreateTabulatedData( zip(finder.Breaks, results) )
+        return len(finder.Peaks())
+    return tabulate
+
+def stagePlot( block, workdir, settings ):
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    finder = finderFor( block, workdir, settings )
+    finder.Run()
+    def plot():
+        fig = Figure()
+        FigureCanvasAgg(fig)
+        finder.Plot(fig)
+        fig.savefig(StringIO(), format='png')
+        return len(finder.Peaks())
+    return plot
+
+STAGES = [ ('parse', stageParse),
+           ('detect', stageDetect),
+           ('bases-scan', stageBases('scan')),
+           ('bases-window', stageBases('window')),
+           ('run', stageRun),
+           ('tabulate', stageTabulate),
+           ('plot', stagePlot) ]
+
+def benchStage( task ):
+    """
+    one stage at one size, in a fresh pool worker so that its peak memory
+    is its own
+    """
+    name, rows, settings = task
+    block = syntheticTraces( rows, settings['series'], settings['density'], settings['noise'] )
+    workdir = tempfile.mkdtemp()
+    try:
+        fn = dict(STAGES)[name]( block, workdir, settings )
+        before = PeakFinder.residentMB()
+        PeakFinder.resetPeakMemory()
+        seconds = best( fn, settings['repeat'] )
+        peak = PeakFinder.peakMemoryMB() - before
+        peaks = fn()
+    finally:
+        shutil.rmtree(workdir)
+
+    return { 'stage': name, 'samples': rows, 'series': settings['series'],
+             'seconds': seconds, 'samples_per_s': rows * settings['series'] / max(seconds, 1e-9),
+             'peak_mb': max(peak, 0.0), 'peaks': peaks, 'label': settings['label'],
+             'when': time.strftime('%Y-%m-%d %H:%M:%S'), 'numpy': np.__version__ }
+
+def gitLabel():
+    """
+    the current commit, to tell stored results apart
+    """
+    here = os.path.dirname(os.path.abspath(PeakFinder.__file__))
+    devnull = open(os.devnull, 'w')
+    try:
+        return subprocess.check_output( ['git', 'rev-parse', '--short', 'HEAD'], cwd=here, stderr=devnull ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+    finally:
+        devnull.close()
+
+def loadResults( filename ):
+    f = open(filename)
+    try:
+        return [ json.loads(line) for line in f if line.strip() ]
+    finally:
+        f.close()
+
+def BenchSuite( settings ):
+    """
+    every stage in settings['stages'] at every size, each in its own
+    process; the results are appended to settings['results'] as JSON
+    lines, and compared with the latest matching ones in
+    settings['compare'], anything more than settings['tolerance'] times
+    slower counting as a regression
+
+    returns the number of regressions
+    """
+    baseline = {}
+    if settings['compare'] is not None:
+        for record in loadResults( settings['compare'] ):
+            baseline[ (record['stage'], record['samples'], record['series']) ] = record
+
+    print "%-14s\t%10s\t%10s\t%12s\t%10s\t%10s\t%10s" % ('stage', 'samples', 'seconds', 'samples/s', 'peak MB', 'peaks', 'vs base')
+    records = []
+    regressions = 0
+    for rows in settings['sizes']:
+        for name in settings['stages']:
+            if name == 'parse' and rows > settings['parse_max']:
+                continue
+            pool = multiprocessing.Pool( 1 )
+            try:
+                record = pool.apply( benchStage, ((name, rows, settings),) )
+            finally:
+                pool.close()
+                pool.join()
+            records.append( record )
+
+            ratio = ''
+            base = baseline.get( (name, rows, settings['series']) )
+            if base is not None:
+                slower = record['seconds'] / max(base['seconds'], 1e-9)
+                ratio = '%.2fx' % slower
+                if slower > settings['tolerance']:
+                    ratio += ' SLOWER'
+                    regressions += 1
+            print "%-14s\t%10d\t%10.4f\t%12.4g\t%10.1f\t%10s\t%10s" % (name, rows, record['seconds'], record['samples_per_s'],
+                                                                    record['peak_mb'], record['peaks'], ratio)
+            sys.stdout.flush()
+
+    if settings['results'] is not None:
+        f = open(settings['results'], 'a')
+        try:
+            for record in records:
+                f.write( json.dumps(record, sort_keys=True) + '\n' )
+        finally:
+            f.close()
+    return regressions
+
+def ParseArgs( argv ):
+    filename = None
+    rows     = 1000000
+    series   = 3
+    repeat   = 3
+    # --suite settings, None unless --suite is given
+    suite    = None
+    settings = { 'sizes': [10**3, 10**4, 10**5, 10**6, 10**7], 'stages': [ name for name, stage in STAGES ],
+                 'density': 5.0, 'noise': 0.05, 'delta': 0.3, 'numnei': 10, 'engine': 'billauer',
+                 'parse_max': 10**6, 'results': None, 'compare': None, 'tolerance': 1.25, 'label': None }
+
+    try:
+        opts, args = getopt.getopt(argv[1:], "f:r:s:", ["file=", "rows=", "series=", "repeat=",
+                                                        "suite", "sizes=", "stages=", "density=", "noise=", "delta=",
+                                                        "numnei=", "engine=", "parse-max=", "results=", "compare=",
+                                                        "tolerance=", "label="])
+    except getopt.GetoptError, err:
+        print str(err)
+        print 'usage: ', argv[0], ' [--file data.csv | --rows 1000000 --series 3] [--repeat 3]'
+        print '       ', argv[0], ' --suite [--sizes 1000,1000000] [--stages detect,run] [--series 3] [--density 5] [--noise 0.05]'
+        print '       ', ' ' * len(argv[0]), ' [--delta 0.3] [--numnei 10] [--engine billauer] [--parse-max 1000000]'
+        print '       ', ' ' * len(argv[0]), ' [--results bench.jsonl] [--compare bench.jsonl] [--tolerance 1.25] [--label name]'
+        sys.exit(2)
+
+    for o, arg in opts:
+        if o in ("-f", "--file"):
+            filename = arg
+        elif o in ("-r", "--rows"):
+            rows = int(arg)
+        elif o in ("-s", "--series"):
+            series = int(arg)
+        elif o in ("--repeat",):
+            repeat = int(arg)
+        elif o in ("--suite",):
+            suite = settings
+        elif o in ("--sizes",):
+            settings['sizes'] = [ int(float(n)) for n in arg.split(',') ]
+        elif o in ("--stages",):
+            settings['stages'] = arg.split(',')
+            unknown = set(settings['stages']) - set( name for name, stage in STAGES )
+            if unknown:
+                sys.exit('unknown stages %s' % ', '.join(sorted(unknown)))
+        elif o in ("--density",):
+            settings['density'] = float(arg)
+        elif o in ("--noise",):
+            settings['noise'] = float(arg)
+        elif o in ("--delta",):
+            settings['delta'] = float(arg)
+        elif o in ("--numnei",):
+            settings['numnei'] = int(arg)
+        elif o in ("--engine",):
+            settings['engine'] = arg
+        elif o in ("--parse-max",):
+            settings['parse_max'] = int(float(arg))
+        elif o in ("--results",):
+            settings['results'] = arg
+        elif o in ("--compare",):
+            settings['compare'] = arg
+        elif o in ("--tolerance",):
+            settings['tolerance'] = float(arg)
+        elif o in ("--label",):
+            settings['label'] = arg
+        else:
+            assert False, "unhandled option"
+
+    if suite is not None:
+        suite['series'] = series
+        suite['repeat'] = repeat
+        if suite['label'] is None:
+            suite['label'] = gitLabel()
+
+    return filename, rows, series, repeat, suite
+
+def main():
+    filename, rows, series, repeat, suite = ParseArgs( sys.argv )
+
+    if suite is not None:
+        if BenchSuite( suite ):
+            sys.exit(1)
+        return
+
+    synthetic = filename is None
+    if synthetic:
+        fd, filename = tempfile.mkstemp(suffix='.csv')
+        os.close(fd)
+        writeSyntheticCSV( filename, rows, series )
+
+    try:
+        BenchStartup( repeat )
+        BenchDetectors( rows, repeat )
+        BenchParse( filename, repeat )
+    finally:
+        if synthetic:
+            os.remove(filename)
+
+if __name__=="__main__":
+    main()
@@ -17,6 +17,7 @@ License: this code is in the public domain
 Last modified: 19.01.2009
 """
 import sys, os, random
+import threading
 from PyQt4.QtCore import *
 from PyQt4.QtGui import *
 
@@ -29,11 +30,92 @@ from matplotlib.figure import Figure
 
 import PeakFinder
 
+# how long the spinboxes have to be left alone before recalculating
+DEBOUNCE_MS = 300
+
+
+class Cancelled(Exception):
+    pass
+
+class Worker(QThread):
+    """
+    runs jobs - functions of a progress callback - one at a time, off the
+    UI thread. Submit() replaces any job still waiting and abandons the
+    one running at its next progress report, so only the latest settings
+    are ever worked through to the end.
+
+    Emits progress(QString) as a job goes, failed(QString) if it raises
+    (a bad delta, a file that won't load), and ready() when it finishes with nothing newer waiting.
+    busy is held while a job runs, so the UI can tell whether it is safe
+    to read the results.
+    """
+    def __init__( self, parent=None ):
+        QThread.__init__(self, parent)
+        self.guard = threading.Condition()
+        self.busy = threading.Lock()
+        self.pending = None
+        self.generation = 0
+        self.quitting = False
+
+    def Submit( self, job, label ):
+        self.guard.acquire()
+        try:
+            self.generation += 1
+            self.pending = (job, label)
+            self.guard.notify()
+        finally:
+            self.guard.release()
+
+    def Stop( self ):
+        self.guard.acquire()
+        try:
+            self.generation += 1
+            self.quitting = True
+            self.guard.notify()
+        finally:
+            self.guard.release()
+        self.wait()
+
+    def run( self ):
+        while True:
+            self.guard.acquire()
+            try:
+                while self.pending is None and not self.quitting:
+                    self.guard.wait()
+                if self.quitting:
+                    return
+                job, label = self.pending
+                self.pending = None
+                generation = self.generation
+            finally:
+                self.guard.release()
+
+            self.busy.acquire()
+            try:
+                job( lambda done, total: self.Progress( generation, label, done, total ) )
+            except Cancelled:
+                continue
+            except Exception, err:
+                self.emit( SIGNAL('failed(QString)'), QString('%s: %s' % (type(err).__name__, err)) )
+                continue
+            finally:
+                self.busy.release()
+
+            if generation == self.generation:
+                self.emit( SIGNAL('ready()') )
+
+    def Progress( self, generation, label, done, total ):
+        if generation != self.generation:
+            raise Cancelled()
+        self.emit( SIGNAL('progress(QString)'), QString('%s: %d of %d series' % (label, done, total)) )
+
 
 class PeakFinderGUI(QMainWindow):
     #def __init__(self, parent=None):
-    def __init__( self, csv, delta, numnei, a, b, c, parent=None):
+    def __init__( self, csv, delta, numnei, a, b, c, timings=False, parent=None):
         QMainWindow.__init__(self, parent)
+        # shows what each stage of a recalculation cost in the status bar
+        self.timings = timings
         self.setWindowTitle('PeakFinder')
 
         self.create_menu()
@@ -47,14 +129,80 @@ class PeakFinderGUI(QMainWindow):
         self.spinboxes['delta'].setValue(float(delta))
         self.csv = csv
 
-        self.myPeakFinder = PeakFinder.PeakFinder( csv, delta, numnei, a, b, c )
-        self.myPeakFinder.Run()
-        self.myPeakFinder.Print()
-
-        self.on_draw()
-
-
-
+        # any change to the spinboxes recalculates, once they settle
+        self.timer = QTimer( self )
+        self.timer.setSingleShot( True )
+        self.timer.setInterval( DEBOUNCE_MS )
+        self.connect( self.timer, SIGNAL('timeout()'), self.on_recalculate )
+        for spinbox in self.spinboxes.values():
+            if isinstance(spinbox, QDoubleSpinBox):
+                self.connect( spinbox, SIGNAL('valueChanged(double)'), self.on_changed )
+            else:
+                self.connect( spinbox, SIGNAL('valueChanged(int)'), self.on_changed )
+        self.connect( self.engine_box, SIGNAL('currentIndexChanged(int)'), self.on_changed )
+        self.connect( self.prefilter_box, SIGNAL('editTextChanged(QString)'), self.on_changed )
+
+        # loading and detection happen on the worker, see Detect
+        self.myPeakFinder = None
+        self.loaded = None
+        self.worker = Worker( self )
+        self.connect( self.worker, SIGNAL('progress(QString)'), self.on_progress )
+        self.connect( self.worker, SIGNAL('failed(QString)'), self.on_failed )
+        self.connect( self.worker, SIGNAL('ready()'), self.on_ready )
+        self.worker.start()
+
+        self.Submit( csv, float(delta), int(numnei), a, b, c, 'loading %s' % csv )
+
+    def Submit( self, csv, delta, numnei, a, b, c, label ):
+        engine = str(self.engine_box.currentText())
+        prefilter = str(self.prefilter_box.currentText())
+        self.worker.Submit( lambda progress: self.Detect( csv, delta, numnei, a, b, c, engine, prefilter, progress ), label )
+
+    def Detect( self, csv, delta, numnei, a, b, c, engine, prefilter, progress ):
+        """
+        worker side of a recalculation: (re)loads csv if it isn't the file
+        already loaded, then detects and prints the peaks
+        """
+        if self.myPeakFinder is None or self.loaded != csv:
+            # a new file gets a finder of its own, so if it fails the old
+            # one is still there to plot
+            finder = PeakFinder.PeakFinder( csv, delta, numnei, a, b, c, engine=engine, prefilter=prefilter, timings=self.timings )
+            if self.myPeakFinder is not None:
+                # detections are keyed by content, they still apply
+                finder.Detections = self.myPeakFinder.Detections
+        else:
+            finder = self.myPeakFinder
+            # only the latest recalculation goes in the status bar
+            finder.Timings.Clear()
+
+        finder.SetEngine( engine, prefilter )
+        finder.Reset( delta, numnei, a, b, c, progress=progress )
+        self.myPeakFinder = finder
+        self.loaded = csv
+        finder.Print()
+
+    def on_progress(self, msg):
+        self.statusBar().showMessage(msg)
+
+    def on_failed(self, msg):
+        self.statusBar().showMessage(msg, 5000)
+
+    def on_ready(self):
+        # a newer job already running will be ready later
+        if not self.worker.busy.acquire(False):
+            return
+        try:
+            if self.myPeakFinder.UpdatePlot( self.fig ):
+                self.canvas.draw_idle()
+            if self.timings:
+                self.status_text.setText( '%s  (%s)' % (self.myPeakFinder.Timings.Line(), self.myPeakFinder.Detections.Stats()) )
+        finally:
+            self.worker.busy.release()
+        self.statusBar().showMessage('done', 2000)
+
+    def closeEvent(self, event):
+        self.worker.Stop()
+        QMainWindow.closeEvent(self, event)
 
     def save_plot(self):
         file_choices = "PNG (*.png)|*.png"
@@ -79,29 +227,22 @@ class PeakFinderGUI(QMainWindow):
         
         QMessageBox.information(self, "Click!", msg)
     
-    def on_draw(self):
-        """ Redraws the figure
-        """
-        self.fig.clear()
+    def on_changed(self, value):
+        # restarts the countdown if it is already running
+        self.timer.start()
 
-        self.myPeakFinder.Plot(self.fig)
-        
-        self.canvas.draw()
-    
     def on_recalculate(self):
+        self.timer.stop()
         A = self.spinboxes['a'].value()
         B = self.spinboxes['b'].value()
         C = self.spinboxes['c'].value()
         delta = self.spinboxes['delta'].value()
         numnei = self.spinboxes['numnei'].value()
-        self.myPeakFinder.Reset( delta, numnei, A, B, C   )
         print
         print
         print '################ recalculating... ######################'
         print
-        self.myPeakFinder.Print()
-
-        self.on_draw()
+        self.Submit( self.csv, delta, numnei, A, B, C, 'recalculating' )
 
     def new_spin_box( self, label, minval, maxval, double=False ):
         if double:
@@ -188,6 +329,19 @@ class PeakFinderGUI(QMainWindow):
             gridlayout.setAlignment(v, Qt.AlignVCenter)
             row += 1
 
+        # detector, and smoothing as name:width[:order] (or none)
+        self.engine_box = QComboBox()
+        self.engine_box.addItems( sorted(PeakFinder.ENGINES) )
+        self.engine_box.setCurrentIndex( self.engine_box.findText('billauer') )
+        self.prefilter_box = QComboBox()
+        self.prefilter_box.setEditable( True )
+        self.prefilter_box.addItems( ['none', 'mean:5', 'mean:25', 'savgol:11:3', 'savgol:51:3'] )
+        for lbl, box in [ ('engine', self.engine_box), ('prefilter', self.prefilter_box) ]:
+            label = QLabel(lbl)
+            gridlayout.addWidget(label,row,0)
+            gridlayout.addWidget(box,row,1)
+            row += 1
+
         # and the draw button...
         gridlayout.addWidget(self.draw_button,row,0)
         #gridlayout.setAlignment(self.draw_button, Qt.AlignVCenter)
@@ -199,7 +353,8 @@ class PeakFinderGUI(QMainWindow):
         gridlayout.setAlignment(self.open_button, Qt.AlignVCenter)
 
         self.quit_button = QPushButton("&Quit")
-        self.connect(self.quit_button, SIGNAL('clicked()'), qApp, SLOT('quit()'))
+        # through closeEvent, so the worker is stopped
+        self.connect(self.quit_button, SIGNAL('clicked()'), self.close)
         gridlayout.addWidget( self.quit_button, row,2 )
         gridlayout.setAlignment(self.quit_button, Qt.AlignVCenter)
 
@@ -215,17 +370,21 @@ class PeakFinderGUI(QMainWindow):
     
     def on_new_file(self):
         filename = QFileDialog.getOpenFileName( self, 'Open CSV file' )
-        self.csv = filename
+        if filename.isEmpty():
+            return
+        self.csv = unicode(filename)
 
         print
         print
         print '################ loaded %s' % self.csv
         print
 
-        self.myPeakFinder.OnNewFile( self.csv )
-        self.myPeakFinder.Run()
-        self.myPeakFinder.Print()
-        self.on_draw()
+        A = self.spinboxes['a'].value()
+        B = self.spinboxes['b'].value()
+        C = self.spinboxes['c'].value()
+        delta = self.spinboxes['delta'].value()
+        numnei = self.spinboxes['numnei'].value()
+        self.Submit( self.csv, delta, numnei, A, B, C, 'loading %s' % self.csv )
 
 
     def create_status_bar(self):
@@ -277,16 +436,17 @@ def ParseArgs( argv ):
     c = 1500
     
     try:
-        opts, args = getopt.getopt(argv[1:], "f:d:n:pa:b:c:", ["file=", "delta=", "numnei=", "plot"])
+        opts, args = getopt.getopt(argv[1:], "f:d:n:pa:b:c:", ["file=", "delta=", "numnei=", "plot", "timings"])
     except getopt.GetoptError, err:
         print str(err)
         #usage()
-        print 'usage: ', argv[0], ' --file data.csv --delta 0.2 --numnei 10 -a 50 -b 500 -c 1500'
+        print 'usage: ', argv[0], ' --file data.csv --delta 0.2 --numnei 10 -a 50 -b 500 -c 1500 [--timings]'
         sys.exit(2)
     
     output = None
     verbose = False
     plotfig = False
+    timings = False
     for o, arg in opts:
         if o in ("-f", "--file"):
             filename = arg
@@ -302,17 +462,19 @@ def ParseArgs( argv ):
             b = arg
         elif o in ("-c"):
             c = arg
+        elif o in ("--timings",):
+            timings = True
         else:
             assert False, "unhandled option"
     
-    return filename, float(delta), int(numnei), plotfig, a, b, c
+    return filename, float(delta), int(numnei), plotfig, a, b, c, timings
     
  
 
 def main():
     app = QApplication(sys.argv)
-    filename, delta, numnei, plotfig, a, b, c = ParseArgs( sys.argv )
-    form = PeakFinderGUI( filename, delta, numnei, a, b, c )
+    filename, delta, numnei, plotfig, a, b, c, timings = ParseArgs( sys.argv )
+    form = PeakFinderGUI( filename, delta, numnei, a, b, c, timings )
     form.show()
     app.exec_()
 
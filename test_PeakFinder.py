@@ -0,0 +1,634 @@
+#!/usr/bin/env python
+"""
+tests for PeakFinder, above all that every engine and detection path
+gives what the reference engine, peakDetectorLoop, gives - to the byte.
+Run them with
+
+    python -m unittest test_PeakFinder
+"""
+import os, sys, shutil, tempfile
+import json
+import cPickle as pickle
+from StringIO import StringIO
+import unittest
+
+import numpy as np
+from numpy import NaN, Inf
+
+import PeakFinder
+
+DELTA = 0.8
+
+def traces( n=1500, seed=0 ):
+    """
+    (name, series) pairs covering the awkward inputs: noise, NaNs, both
+    infinities, flat tops and bottoms, and float32 storage
+    """
+    rng = np.random.RandomState(seed)
+    walk = np.cumsum(rng.randn(n))
+
+    nans = walk.copy()
+    nans[rng.randint(0, n, n // 50)] = NaN
+    nans[:20] = NaN
+
+    infs = walk.copy()
+    infs[rng.randint(0, n, 5)] = Inf
+    infs[rng.randint(0, n, 5)] = -Inf
+
+    plateaus = np.round(walk / 2)
+    plateaus[100:180] = plateaus[99]
+
+    return [ ('walk', walk), ('nans', nans), ('infs', infs), ('plateaus', plateaus),
+             ('float32', walk.astype(np.float32)), ('float32 nans', nans.astype(np.float32)),
+             ('short', walk[:3]), ('empty', walk[:0]) ]
+
+def bruteProminence( v, peaks ):
+    """
+    prominence straight from its definition, a peak at a time
+    """
+    v = np.where(np.isnan(v), Inf, np.asarray(v, dtype=np.float64))
+    out = []
+    for k, p in enumerate(peaks):
+        higher = [ q for q in peaks if v[q] > v[p] ]
+        left = max([ q for q in higher if q < p ] or [0])
+        right = min([ q for q in higher if q > p ] or [len(v)])
+        out.append( v[p] - max(v[left:p].min(), v[p:right].min()) )
+    return np.asarray(out)
+
+class ReferenceTest( unittest.TestCase ):
+    """
+    tests against what peakDetectorLoop finds in traces()
+    """
+    def assertSame( self, expected, result, msg ):
+        self.assertEqual( expected.has_bases, result.has_bases, msg )
+        self.assertEqual( expected.peaks.tobytes(), result.peaks.tobytes(), msg )
+        self.assertEqual( expected.minima.tobytes(), result.minima.tobytes(), msg )
+
+    def references( self, numneis=(-1, 1, 6, 40) ):
+        for name, v in traces():
+            for numnei in numneis:
+                yield name, v, numnei, PeakFinder.peakDetectorLoop( v, DELTA, numnei )
+
+    def block( self ):
+        """
+        a column-major block of timestamps and four of traces()
+        """
+        series = [ v for name, v in traces() if name in ('walk', 'nans', 'infs', 'plateaus') ]
+        return np.asfortranarray( np.column_stack( [np.arange(len(series[0]))] + series ) )
+
+class EquivalenceTest( ReferenceTest ):
+    """
+    every delta hysteresis engine, timed or not, with each base mode
+    """
+    def testEngines( self ):
+        for name, v, numnei, expected in self.references():
+            for engine in PeakFinder.BILLAUER_ENGINES:
+                for basemode in PeakFinder.BASE_MODES:
+                    msg = (name, numnei, engine, basemode)
+                    self.assertSame( expected, PeakFinder.detect( v, DELTA, numnei, engine, basemode ), msg )
+                    # timed, with the bases found separately
+                    timings = PeakFinder.Timings()
+                    self.assertSame( expected, PeakFinder.detect( v, DELTA, numnei, engine, basemode, None, timings ), msg )
+
+class BasesTest( unittest.TestCase ):
+    """
+    the sliding window minimum finds the same bases as scanning each
+    peak's neighbourhood
+    """
+    def testBases( self ):
+        for name, v in traces():
+            positions = PeakFinder.localMaxima( v )
+            for numnei in (1, 6, 40):
+                scan = PeakFinder.findBases( v, positions, numnei, 'scan' )
+                window = PeakFinder.findBases( v, positions, numnei, 'window' )
+                self.assertEqual( scan[0].tolist(), window[0].tolist(), (name, numnei) )
+                self.assertEqual( scan[1].tobytes(), window[1].tobytes(), (name, numnei) )
+
+    def testNeighbourhood( self ):
+        v = traces()[0][1]
+        positions = PeakFinder.localMaxima( v )
+        for numnei in (1, 6, 40):
+            found = PeakFinder.findBases( v, positions, numnei, 'window' )
+            expected = [ PeakFinder.getLowestInNeighbourhood( v, p, numnei ) for p in positions ]
+            self.assertEqual( [ i for x, i in expected ], found[0].tolist(), numnei )
+            self.assertEqual( [ x for x, i in expected ], found[1].tolist(), numnei )
+
+class FileTest( unittest.TestCase ):
+    """
+    tests that write their files to a temporary directory
+    """
+    def setUp( self ):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown( self ):
+        shutil.rmtree(self.dir)
+
+    def write( self, text, name='traces.csv' ):
+        filename = os.path.join(self.dir, name)
+        f = open(filename, 'wb')
+        f.write(text)
+        f.close()
+        return filename
+
+class LoadCSVTest( FileTest ):
+    """
+    loadCSV parses what numpy.loadtxt does, a chunk at a time, and refuses
+    anything that isn't a full table of numbers
+    """
+
+    def testChunks( self ):
+        rng = np.random.RandomState(0)
+        expected = np.column_stack( (np.arange(200) * 0.25, rng.randn(200, 3)) )
+        text = ''.join( ','.join( repr(x) for x in row ) + ('\r\n' if k % 3 else '\n') for k, row in enumerate(expected) )
+        filename = self.write( text + '\n\n' )
+        self.assertEqual( (200, 4), PeakFinder.countCSV( filename ) )
+        for chunksize in (1, 7, 100, 1 << 20):
+            block = PeakFinder.loadCSV( filename, chunksize=chunksize )
+            self.assertTrue( block.flags.f_contiguous )
+            self.assertEqual( expected.tobytes(), np.ascontiguousarray(block).tobytes(), chunksize )
+
+    def testFloat32( self ):
+        times = 1e6 + np.arange(10) * 0.001
+        filename = self.write( ''.join( '%r,%r\n' % (x, k * 0.5) for k, x in enumerate(times) ) )
+        out = np.empty((10, 2), dtype=np.float32, order='F')
+        found = np.empty(10)
+        PeakFinder.loadCSV( filename, np.float32, out=out, times=found )
+        self.assertEqual( times.tolist(), found.tolist() )
+        self.assertEqual( (np.arange(10) * 0.5).tolist(), out[:,1].tolist() )
+
+    def testMalformed( self ):
+        for text in [ '0,1,2\n1,3\n2,5,6\n', '0,1,2\n\n2,5,6\n', '0,1,2\n1,x,4\n', '0,1,2\n1,3,4,5\n' ]:
+            filename = self.write( text )
+            for chunksize in (3, 1 << 20):
+                self.assertRaises( ValueError, PeakFinder.loadCSV, filename, chunksize=chunksize )
+
+    def testOutShape( self ):
+        filename = self.write( '0,1,2\n1,3,4\n' )
+        self.assertRaises( ValueError, PeakFinder.loadCSV, filename, out=np.empty((3, 3), order='F') )
+
+class LoadTracesTest( FileTest ):
+    """
+    a CSV file is converted to .npy once and mapped from there, until the
+    CSV changes
+    """
+    def testCache( self ):
+        filename = self.write( '0,1,2\n1,3,4\n' )
+        times, block = PeakFinder.loadTraces( filename )
+        self.assertTrue( isinstance(block, np.memmap) )
+        self.assertEqual( [[0, 1, 2], [1, 3, 4]], block.tolist() )
+        npyname, timesname, keyname = PeakFinder.cachePaths( filename, np.float64 )
+
+        # unchanged, mapped again without converting
+        converted = int(os.stat(npyname).st_mtime) - 10
+        os.utime( npyname, (converted, converted) )
+        times, block = PeakFinder.loadTraces( filename )
+        self.assertEqual( converted, os.stat(npyname).st_mtime )
+
+        # a different size
+        self.write( '0,1,2\n1,3,4\n2,5,6\n' )
+        times, block = PeakFinder.loadTraces( filename )
+        self.assertEqual( [0, 1, 2], times.tolist() )
+        self.assertEqual( [[0, 1, 2], [1, 3, 4], [2, 5, 6]], block.tolist() )
+
+        # the same size, a different mtime
+        mtime = int(os.stat(filename).st_mtime) + 10
+        self.write( '0,1,2\n1,3,4\n2,7,8\n' )
+        os.utime( filename, (mtime, mtime) )
+        times, block = PeakFinder.loadTraces( filename )
+        self.assertEqual( [2, 7, 8], block[2].tolist() )
+
+    def testNoCache( self ):
+        filename = self.write( '0,1,2\n1,3,4\n' )
+        times, block = PeakFinder.loadTraces( filename, cache=False )
+        self.assertFalse( isinstance(block, np.memmap) )
+        self.assertEqual( ['traces.csv'], os.listdir(self.dir) )
+        self.assertRaises( ValueError, PeakFinder.loadTraces, filename, cache=False, parse=False )
+
+    def testFloat32( self ):
+        times = 1e6 + np.arange(10) * 0.001
+        filename = self.write( ''.join( '%r,%r\n' % (x, k * 0.5) for k, x in enumerate(times) ) )
+        for repeat in range(2):
+            found, block = PeakFinder.loadTraces( filename, np.float32 )
+            self.assertEqual( np.float32, block.dtype )
+            self.assertEqual( times.tolist(), found.tolist() )
+
+def scanToIdx( val, data ):
+    """
+    the original valToIdx, a linear scan
+    """
+    idx = 0
+    cur = 0
+    val = float(val)
+    while cur < val and idx < len(data):
+        cur = data[idx]
+        idx += 1
+    return int(idx)
+
+class ValToIdxTest( unittest.TestCase ):
+    """
+    valToIdx by binary search, in both its compat and exact forms
+    """
+    def testValToIdx( self ):
+        data = np.array( [0.0, 0.5, 1.0, 1.0, 1.0, 2.5, 4.0, 7.25] )
+        vals = [ -1.0, 0.0, 0.25, 0.5, 0.75, 1.0, 1.1, 2.5, 3.0, 7.25, 8.0, 100.0 ]
+        for val in vals:
+            self.assertEqual( scanToIdx( val, data ), PeakFinder.valToIdx( val, data ), val )
+            self.assertEqual( int(np.flatnonzero( np.append(data, Inf) >= val )[0]), PeakFinder.valToIdx( val, data, False ), val )
+        self.assertEqual( [ scanToIdx( val, data ) for val in vals ], PeakFinder.valToIdx( vals, data ).tolist() )
+        self.assertEqual( 0, PeakFinder.valToIdx( 1.0, [] ) )
+
+class StreamingTest( ReferenceTest ):
+    """
+    StreamingPeakDetector fed a chunk at a time finds what detecting the
+    whole series does, each as soon as it is confirmed
+    """
+    def testStreaming( self ):
+        for name, v, numnei, expected in self.references( (-1, 6) ):
+            for step in (1, 97, len(v) + 1):
+                detector = PeakFinder.StreamingPeakDetector( DELTA, numnei )
+                found = { 'Maxima': [], 'Minima': [], 'Bases': [] }
+                for lo in range(0, len(v), step):
+                    for key, tab in detector.push( v[lo:lo+step] ).items():
+                        found[key].extend( tab )
+                for key, tab in detector.close().items():
+                    found[key].extend( tab )
+                for key in found:
+                    self.assertEqual( [ (int(p), float(x)) for p, x in expected[key] ],
+                                      [ (int(p), float(x)) for p, x in found[key] ], (name, numnei, step, key) )
+
+    def testConfirmed( self ):
+        # a maximum comes out of the push that took the series delta below it
+        v = np.array( [0.0, 1.0, 2.0, 1.5, 0.5, 0.4, 3.0] )
+        detector = PeakFinder.StreamingPeakDetector( 1.0, 1 )
+        self.assertEqual( [], detector.push( v[:4] )['Maxima'] )
+        found = detector.push( v[4:] )
+        self.assertEqual( [(2, 2.0)], [ (int(p), float(x)) for p, x in found['Maxima'] ] )
+        self.assertEqual( [(1, 1.0)], [ (int(p), float(x)) for p, x in found['Bases'] ] )
+        self.assertEqual( [(5, 0.4)], [ (int(p), float(x)) for p, x in found['Minima'] ] )
+        self.assertEqual( [], detector.close()['Bases'] )
+
+class ResultCacheTest( FileTest ):
+    """
+    ResultCache keeps the most recently used results, and survives being
+    saved and loaded
+    """
+    def result( self, k ):
+        return PeakFinder.peakDetectorLoop( traces( 300, k )[0][1], DELTA, 6 )
+
+    def testEviction( self ):
+        cache = PeakFinder.ResultCache( 2 )
+        results = [ self.result( k ) for k in range(3) ]
+        cache.Put( 'a', results[0] )
+        cache.Put( 'b', results[1] )
+        self.assertTrue( cache.Get( 'a' ) is results[0] )
+        # b is now the least recently used
+        cache.Put( 'c', results[2] )
+        self.assertEqual( None, cache.Get( 'b' ) )
+        self.assertTrue( cache.Get( 'c' ) is results[2] )
+        self.assertTrue( cache.Get( 'a' ) is results[0] )
+        self.assertEqual( (3, 1), (cache.hits, cache.misses) )
+        self.assertEqual( '2 results cached, 3 hits, 1 misses', cache.Stats() )
+
+    def testPersistence( self ):
+        filename = os.path.join(self.dir, 'results.pkl')
+        cache = PeakFinder.ResultCache( 4, filename )
+        results = [ self.result( k ) for k in range(3) ]
+        for k, result in enumerate(results):
+            cache.Put( (k, 0.5), result )
+        cache.Save()
+
+        # plain tuples, loadable whether PeakFinder ran as __main__ or not
+        f = open(filename, 'rb')
+        saved = pickle.load(f)
+        f.close()
+        self.assertEqual( [ tuple ] * 3, [ type(state) for key, state in saved ] )
+
+        loaded = PeakFinder.ResultCache( 2, filename )
+        self.assertEqual( [(1, 0.5), (2, 0.5)], loaded.entries.keys() )
+        for k in (1, 2):
+            result = loaded.Get( (k, 0.5) )
+            self.assertTrue( isinstance(result, PeakFinder.PeakResult) )
+            self.assertEqual( results[k].peaks.tobytes(), result.peaks.tobytes() )
+            self.assertEqual( results[k].minima.tobytes(), result.minima.tobytes() )
+            self.assertEqual( results[k]['Bases'], result['Bases'] )
+
+        # nothing changed, nothing written
+        os.remove(filename)
+        loaded.Save()
+        self.assertFalse( os.path.exists(filename) )
+
+    def testUnreadable( self ):
+        filename = self.write( 'not a pickle', 'results.pkl' )
+        stderr, sys.stderr = sys.stderr, StringIO()
+        try:
+            cache = PeakFinder.ResultCache( 4, filename )
+            warning = sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+        self.assertEqual( 0, len(cache.entries) )
+        self.assertTrue( warning.startswith('Warning:') )
+
+class TraceFileTest( FileTest ):
+    """
+    tests of PeakFinder over a CSV file of three of traces()
+    """
+    def setUp( self ):
+        FileTest.setUp( self )
+        series = [ v for name, v in traces( 5000 ) if name in ('walk', 'nans', 'plateaus') ]
+        block = np.column_stack( [np.arange(len(series[0])) * 0.5] + series )
+        self.csv = os.path.join(self.dir, 'traces.csv')
+        np.savetxt(self.csv, block, fmt='%.6f', delimiter=',')
+
+    def finder( self, delta=DELTA, **options ):
+        finder = PeakFinder.PeakFinder( self.csv, delta, 6, 0, 0, 0, segments=[0, 500, 1700, 0], **options )
+        finder.Run()
+        return finder
+
+    def peaks( self, **options ):
+        return self.finder( **options ).Peaks()
+
+class SweepTest( TraceFileTest ):
+    """
+    sweeping many deltas at once gives what detecting with each does
+    """
+    def testSweepExtrema( self ):
+        deltas = [ 2.0, 0.3, 0.8, 5.0, 0.3 ]
+        for name, v in traces():
+            found = PeakFinder.sweepExtrema( v, deltas )
+            for delta, positions in zip(deltas, found):
+                maxtab = PeakFinder.peakDetectorLoop( v, delta )['Maxima']
+                self.assertEqual( [ int(p) for p, x in maxtab ], positions.tolist(), (name, delta) )
+
+    def testSweep( self ):
+        deltas = [ 0.5, 3.0, DELTA ]
+        sweep = self.finder().Sweep( deltas )
+        for delta in deltas:
+            summary = self.finder( delta ).Summary()
+            rows = sweep[ sweep['delta'] == delta ]
+            self.assertEqual( summary['series'].tolist(), rows['series'].tolist() )
+            self.assertEqual( summary['segment'].tolist(), rows['segment'].tolist() )
+            self.assertEqual( summary['count'].tolist(), rows['count'].tolist() )
+            np.testing.assert_allclose( summary['mean_delta'], rows['mean_delta'] )
+            np.testing.assert_allclose( summary['mean_isp'], rows['mean_isp'] )
+
+class SummaryTest( TraceFileTest ):
+    """
+    Summary's statistics, worked out again from the peaks
+    """
+    def testSummary( self ):
+        for numnei, options in [ (6, {}), (-1, dict(engine='loop')) ]:
+            finder = self.finder( **options )
+            if numnei < 0:
+                finder.Reset( DELTA, numnei, 0, 0, 0, segments=[0, 500, 1700, 0] )
+            summary = finder.Summary()
+            peaks = finder.Peaks()
+            edges = finder.Times[ np.minimum(finder.Breaks, len(finder.Times) - 1) ]
+            self.assertEqual( len(finder.Data) * (len(finder.Breaks) - 1), len(summary) )
+            for row in summary:
+                mine = peaks[ (peaks['series'] == row['series']) & (peaks['segment'] == row['segment']) ]
+                start, end = edges[row['segment']], edges[row['segment'] + 1]
+                self.assertEqual( (start, end), (row['start'], row['end']) )
+                self.assertEqual( len(mine), row['count'] )
+                self.assertAlmostEqual( len(mine) / (end - start), row['rate'] )
+                isps = np.diff( mine['time'] )
+                expected = [ np.mean(isps), np.median(isps), np.std(isps) ]
+                np.testing.assert_allclose( expected, [ row['mean_isp'], row['median_isp'], row['std_isp'] ] )
+                expected = [ NaN ] * 3
+                if numnei > 0:
+                    expected = [ np.mean(mine['delta']), np.median(mine['delta']), np.std(mine['delta']) ]
+                np.testing.assert_allclose( expected, [ row['mean_delta'], row['median_delta'], row['std_delta'] ] )
+
+    def testEmpty( self ):
+        result = PeakFinder.peakDetectorLoop( np.zeros(100), DELTA, 6 )
+        stats = result.Stats()
+        self.assertEqual( 0, stats[0] )
+        self.assertTrue( np.isnan(stats[1:]).all() )
+
+class OutputTest( TraceFileTest ):
+    """
+    Write's tables read back the same from each of OUTPUT_FORMATS
+    """
+    def testNpz( self ):
+        finder = self.finder()
+        filename = os.path.join(self.dir, 'peaks.npz')
+        finder.Write( filename )
+        found = np.load( filename )
+        for name, table in [ ('peaks', finder.Peaks()), ('summary', finder.Summary()) ]:
+            for field in table.dtype.names:
+                self.assertEqual( table[field].tobytes(), found['%s.%s' % (name, field)].tobytes(), (name, field) )
+
+    def testJSONLines( self ):
+        finder = self.finder()
+        filename = os.path.join(self.dir, 'peaks.out')
+        finder.Write( filename, 'jsonl' )
+        rows = [ json.loads(line) for line in open(filename) ]
+        for name, table in [ ('peaks', finder.Peaks()), ('summary', finder.Summary()) ]:
+            mine = [ row for row in rows if row['table'] == name ]
+            self.assertEqual( len(table), len(mine), name )
+            for field in table.dtype.names:
+                expected = [ None if isinstance(x, float) and not np.isfinite(x) else x for x in table[field].tolist() ]
+                self.assertEqual( expected, [ row[field] for row in mine ], (name, field) )
+
+    def testUnknownFormat( self ):
+        self.assertRaises( ValueError, self.finder().Write, os.path.join(self.dir, 'peaks.txt') )
+
+class BatchTest( TraceFileTest ):
+    """
+    runBatch detects every file on its own, a bad file failing alone
+    """
+    def testFailures( self ):
+        expected = self.peaks( cache=False )
+        bad = self.write( '0,1,2\n1,3\n', 'bad.csv' )
+        missing = os.path.join(self.dir, 'missing.csv')
+        files = [ bad, self.csv, missing, self.csv ]
+        options = dict( cache=False, segments=[0, 500, 1700, 0] )
+        for workers in (1, 2):
+            reported = []
+            results = PeakFinder.runBatch( files, DELTA, 6, 0, 0, 0, options, workers, reported.append )
+            self.assertEqual( files, [ result[0] for result in results ] )
+            self.assertEqual( files, [ result[0] for result in reported ] )
+            for filename, seconds, error, peaks, summary in results:
+                if filename == self.csv:
+                    self.assertEqual( None, error )
+                    self.assertEqual( expected.tobytes(), peaks.tobytes(), workers )
+                else:
+                    self.assertTrue( error.startswith('ValueError' if filename == bad else 'IOError'), error )
+                    self.assertEqual( None, peaks )
+        # no caches left next to the inputs
+        self.assertEqual( ['bad.csv', 'traces.csv'], sorted(os.listdir(self.dir)) )
+
+class EnvelopeTest( unittest.TestCase ):
+    """
+    the decimated plot keeps the lowest and highest sample of every run
+    """
+    def testEnvelope( self ):
+        for name, v in traces( 10007 ):
+            times = np.arange(len(v)) * 0.5
+            for bins in (1, 100, 3000, 6000):
+                x, y = PeakFinder.envelope( times, v, bins )
+                if len(v) <= 2*bins:
+                    self.assertTrue( x is times and y is v, (name, bins) )
+                    continue
+                step = -(-len(v) // bins)
+                runs = [ np.asarray(v[lo:lo+step], dtype=np.float64) for lo in range(0, len(v), step) ]
+                self.assertEqual( np.repeat(times[::step], 2).tolist(), x.tolist(), (name, bins) )
+                lows = [ np.nan if np.isnan(run).all() else np.nanmin(run) for run in runs ]
+                highs = [ np.nan if np.isnan(run).all() else np.nanmax(run) for run in runs ]
+                np.testing.assert_array_equal( lows, y[0::2], (name, bins) )
+                np.testing.assert_array_equal( highs, y[1::2], (name, bins) )
+
+class PlotTest( TraceFileTest ):
+    """
+    after a Reset, UpdatePlot redraws only the markers that changed
+    """
+    def figure( self ):
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        fig = Figure()
+        FigureCanvasAgg( fig )
+        return fig
+
+    def testUpdatePlot( self ):
+        finder = self.finder()
+        fig = self.figure()
+        finder.Plot( fig )
+        lines = [ line.line for line in finder.Lines ]
+        marks = list( finder.Marks )
+        self.assertFalse( finder.UpdatePlot( fig ) )
+
+        finder.Reset( 3.0, 6, 0, 0, 0, segments=[0, 500, 1700, 0] )
+        self.assertTrue( finder.UpdatePlot( fig ) )
+        self.assertEqual( lines, [ line.line for line in finder.Lines ] )
+        for i, (ax, key, artists) in enumerate(finder.Marks):
+            self.assertEqual( finder.MarksKey( i ), key )
+            self.assertTrue( ax is marks[i][0] )
+            # the old markers are gone from the axes
+            for artist in marks[i][2]:
+                self.assertFalse( artist in ax.lines or artist in ax.collections )
+            # the peaks, then their bases
+            scatter = artists[-2]
+            self.assertEqual( sum( len(result) for result in finder.Results[i] ), len(scatter.get_offsets()) )
+
+        # the same results again, nothing to redraw
+        finder.Reset( 3.0, 6, 0, 0, 0, segments=[0, 500, 1700, 0] )
+        self.assertFalse( finder.UpdatePlot( fig ) )
+
+        # a figure Plot didn't draw is drawn from scratch
+        other = self.figure()
+        self.assertTrue( finder.UpdatePlot( other ) )
+        self.assertEqual( len(finder.Data), len(other.axes) )
+
+class EngineTest( unittest.TestCase ):
+    """
+    the engines other than the delta hysteresis, against their definitions
+    """
+    def testProminence( self ):
+        for name, v in traces():
+            if name == 'infs':
+                continue
+            peaks = PeakFinder.localMaxima( v )
+            expected = bruteProminence( v, peaks )
+            np.testing.assert_array_equal( expected, PeakFinder.prominence( v, peaks ), name )
+            found = PeakFinder.peakDetectorProminence( v, DELTA ).peaks['index']
+            self.assertEqual( peaks[ expected >= DELTA ].tolist(), found.tolist(), name )
+
+    def testDerivative( self ):
+        for name, v in traces():
+            peaks = PeakFinder.localMaxima( v )
+            work = np.where(np.isnan(v), Inf, np.asarray(v, dtype=np.float64))
+            edges = [0] + peaks.tolist() + [len(v)]
+            lows = [ work[lo:hi].min() if hi > lo else Inf for lo, hi in zip(edges[:-1], edges[1:]) ]
+            keep = [ p for k, p in enumerate(peaks) if work[p] - max(lows[k], lows[k+1]) > DELTA ]
+            found = PeakFinder.peakDetectorDerivative( v, DELTA ).peaks['index']
+            self.assertEqual( keep, found.tolist(), name )
+
+    def testUnknown( self ):
+        self.assertRaises( ValueError, PeakFinder.PeakFinder, 'no such file.csv', DELTA, 6, 0, 0, 0, engine='nonesuch' )
+
+class ChunkTest( ReferenceTest ):
+    """
+    detection a chunk of rows at a time finds what detecting whole series
+    does, whatever the chunk size
+    """
+    def testChunked( self ):
+        for name, v, numnei, expected in self.references():
+            for chunk in (1, 3, 64, 1000, len(v) + 1):
+                self.assertSame( expected, PeakFinder.detectChunked( v, DELTA, numnei, chunk ), (name, numnei, chunk) )
+
+    def testRows( self ):
+        block = self.block()
+        columns = [ 4, 1, 3 ]
+        for numnei in (-1, 6):
+            expected = [ PeakFinder.peakDetectorLoop( block[:,j], DELTA, numnei ) for j in columns ]
+            for chunk in (1, 50, len(block)):
+                for j, e, r in zip(columns, expected, PeakFinder.detectRows( block, columns, DELTA, numnei, chunk )):
+                    self.assertSame( e, r, (j, numnei, chunk) )
+
+class BatchColumnsTest( ReferenceTest ):
+    """
+    detecting many columns together with batchExtrema finds what detecting
+    each alone does
+    """
+    def testColumns( self ):
+        block = self.block()
+        columns = [ 4, 1, 3 ]
+        for numnei in (-1, 6):
+            expected = [ PeakFinder.peakDetectorLoop( block[:,j], DELTA, numnei ) for j in columns ]
+            # enough columns to be stepped through together, and too few
+            many = columns * (PeakFinder.BATCH_COLUMNS // len(columns) + 1)
+            for j, e, r in zip(many, expected * len(many), PeakFinder.detectBatch( block, many, DELTA, numnei )):
+                self.assertSame( e, r, ('batch', j, numnei) )
+            for j, e, r in zip(columns, expected, PeakFinder.detectBatch( block, columns, DELTA, numnei )):
+                self.assertSame( e, r, ('few', j, numnei) )
+
+    def testSparse( self ):
+        # long phases, which stay batched rather than being handed over
+        rng = np.random.RandomState(0)
+        t = np.arange(20000) * 0.01
+        series = [ np.sin(t * rng.uniform(0.5, 2)) * 3 + 0.05 * rng.randn(len(t)) for j in range(PeakFinder.BATCH_COLUMNS) ]
+        series[3][5000:5100] = NaN
+        block = np.asfortranarray( np.column_stack( series ) )
+        deltas = rng.uniform(0.5, 2, len(series))
+        for j, (maxima, minima) in enumerate( PeakFinder.batchExtrema( block, deltas ) ):
+            expected = PeakFinder.peakDetectorLoop( block[:,j], deltas[j] )
+            self.assertEqual( expected.peaks['index'].tolist(), maxima[0].tolist(), j )
+            self.assertEqual( expected.peaks['value'].tolist(), maxima[1].tolist(), j )
+            self.assertEqual( expected.minima['index'].tolist(), minima[0].tolist(), j )
+
+class PeakFinderTest( TraceFileTest ):
+    """
+    the ways PeakFinder.Run can detect a file all give the same peaks
+    """
+
+    def testRuns( self ):
+        expected = self.peaks( engine='loop', cache=False )
+        for options in [ dict(), dict(cache=False), dict(engine='batch'), dict(chunk=333),
+                         dict(workers=2), dict(workers=2, chunk=333), dict(timings=True) ]:
+            self.assertEqual( expected.tobytes(), self.peaks( **options ).tobytes(), options )
+
+    def testChunkNeedsCache( self ):
+        # chunked detection never parses the whole file into memory
+        self.assertRaises( ValueError, self.peaks, chunk=333, cache=False )
+
+    def testChunkKeys( self ):
+        # chunked runs key series on the mapped file, not its contents
+        finder = self.finder( chunk=333 )
+        keys = [ finder.DetectionKey( i ) for i in range(len(finder.Data)) ]
+        self.assertEqual( len(keys), len(set(keys)) )
+        for key in keys:
+            self.assertTrue( finder.Block.filename in key[1], key )
+
+    def testPrefilter( self ):
+        expected = self.peaks( engine='numpy', prefilter='mean:25' )
+        for options in [ dict(engine='batch'), dict(engine='batch', workers=2) ]:
+            self.assertEqual( expected.tobytes(), self.peaks( prefilter='mean:25', **options ).tobytes(), options )
+
+    def testFailedReset( self ):
+        finder = self.finder()
+        before = finder.Peaks()
+        self.assertRaises( ValueError, finder.Reset, 0.0, 6, 100, 900, 2000 )
+        self.assertEqual( [0, 500, 1700, 0], finder.BreakTimes )
+        self.assertEqual( before.tobytes(), finder.Peaks().tobytes() )
+
+if __name__ == '__main__':
+    unittest.main()